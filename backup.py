@@ -0,0 +1,225 @@
+import os
+import json
+import gzip
+import hashlib
+import logging
+import argparse
+from datetime import datetime
+
+# Настройка логирования
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DATA_FILE = "data.json"
+BACKUP_DIR = "backups"
+MANIFEST_FILE = "manifest.json"
+CHUNK_SIZE = 256  # Сколько героев сбрасывать в gzip за раз
+
+READ_SIZE = 1 << 16  # Сколько байт базы читать за раз
+
+# Потоковый разбор data.json: по одной паре (id, герой), без загрузки всей базы в память.
+# Значение принимается, только если после него в буфере уже есть символ: так недочитанное
+# число в конце буфера не разберётся как целое.
+def iter_users(f):
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = f.read(READ_SIZE)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    def expect(chars):
+        nonlocal pos
+        skip()
+        if pos >= len(buf) or buf[pos] not in chars:
+            raise ValueError(f"Ожидался один из {chars!r} в data.json")
+        pos += 1
+        return buf[pos - 1]
+
+    def value():
+        nonlocal pos
+        skip()
+        while True:
+            try:
+                result, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    pos = end
+                    return result
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+
+    fill()
+    skip()
+    if eof and pos >= len(buf):
+        return  # Пустой файл — пустая база
+    expect("{")
+    skip()
+    if pos < len(buf) and buf[pos] == "}":
+        return
+    while True:
+        user_id = value()
+        expect(":")
+        yield user_id, value()
+        if expect(",}") == "}":
+            return
+
+# Снимок базы на момент открытия файла.
+# save_data() заменяет data.json через os.replace, поэтому открытый дескриптор
+# указывает на целую старую версию, а бот при этом не останавливается.
+def open_snapshot(data_file):
+    try:
+        f = open(data_file, "r", encoding="utf-8")
+    except FileNotFoundError:
+        return None, None
+    st = os.fstat(f.fileno())
+    return f, [st.st_ino, st.st_mtime_ns, st.st_size]
+
+def user_hash(user):
+    return hashlib.sha1(json.dumps(user, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def load_manifest(backup_dir):
+    try:
+        with open(os.path.join(backup_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_manifest(backup_dir, manifest):
+    path = os.path.join(backup_dir, MANIFEST_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+# Потоковая запись бэкапа: одна строка JSON на героя, в gzip порциями по CHUNK_SIZE
+def write_backup(path, header, records):
+    written = 0
+    with gzip.open(path + ".tmp", "wt", encoding="utf-8") as out:
+        out.write(json.dumps(header, ensure_ascii=False) + "\n")
+        chunk = []
+        for record in records:
+            chunk.append(json.dumps(record, ensure_ascii=False))
+            if len(chunk) >= CHUNK_SIZE:
+                out.write("\n".join(chunk) + "\n")
+                written += len(chunk)
+                chunk = []
+        if chunk:
+            out.write("\n".join(chunk) + "\n")
+            written += len(chunk)
+    os.replace(path + ".tmp", path)
+    return written
+
+def backup(data_file, backup_dir, incremental=False):
+    os.makedirs(backup_dir, exist_ok=True)
+    manifest = load_manifest(backup_dir)
+    if incremental and not manifest:
+        logger.warning("Предыдущий бэкап не найден, делаем полный.")
+        incremental = False
+
+    snapshot, generation = open_snapshot(data_file)
+    if incremental and generation == manifest["generation"]:
+        if snapshot:
+            snapshot.close()
+        logger.info("База не изменилась с последнего бэкапа, пропускаем.")
+        return None
+
+    kind = "incremental" if incremental else "full"
+    name = f"{kind}-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}.jsonl.gz"
+    path = os.path.join(backup_dir, name)
+    old_hashes = manifest["hashes"] if incremental else {}
+    chain = manifest["chain"] + [name] if incremental else [name]
+
+    # В памяти только хэши героев для манифеста, сами герои идут из файла прямо в gzip
+    hashes = {}
+    def records():
+        if snapshot:
+            with snapshot:
+                for user_id, user in iter_users(snapshot):
+                    hashes[user_id] = user_hash(user)
+                    if old_hashes.get(user_id) != hashes[user_id]:
+                        yield {"id": user_id, "user": user}
+        for user_id in old_hashes:
+            if user_id not in hashes:
+                yield {"id": user_id, "deleted": True}
+
+    header = {"type": kind, "generation": generation, "created": datetime.now().isoformat()}
+    written = write_backup(path, header, records())
+    save_manifest(backup_dir, {"generation": generation, "hashes": hashes, "chain": chain})
+    logger.info(f"Бэкап {name} записан: {written} записей ({os.path.getsize(path)} байт)")
+    return path
+
+def iter_backup(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        yield header
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+# Восстановление: полный бэкап и все инкрементальные после него по цепочке из манифеста
+def restore(data_file, backup_dir, until=None):
+    manifest = load_manifest(backup_dir)
+    if not manifest:
+        raise FileNotFoundError(f"В {backup_dir} нет {MANIFEST_FILE}")
+    chain = manifest["chain"]
+    if until:
+        if until not in chain:
+            raise ValueError(f"{until} нет в цепочке бэкапов {backup_dir}: {', '.join(chain)}")
+        chain = chain[:chain.index(until) + 1]
+
+    users = {}
+    for name in chain:
+        records = iter_backup(os.path.join(backup_dir, name))
+        header = next(records)
+        if header["type"] == "full":
+            users = {}
+        for record in records:
+            if record.get("deleted"):
+                users.pop(record["id"], None)
+            else:
+                users[record["id"]] = record["user"]
+        logger.info(f"Применён бэкап {name}")
+
+    tmp_file = data_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(users, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, data_file)
+    logger.info(f"Восстановлено героев: {len(users)} в {data_file}. Перезапусти бота, чтобы он перечитал базу.")
+    return users
+
+def main():
+    parser = argparse.ArgumentParser(description="Бэкап и восстановление базы героев TimeQuest")
+    parser.add_argument("--data", default=DATA_FILE, help="файл базы героев")
+    parser.add_argument("--dir", default=BACKUP_DIR, help="каталог бэкапов")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("full", help="полный бэкап")
+    sub.add_parser("incremental", help="изменения с последнего бэкапа")
+    restore_parser = sub.add_parser("restore", help="восстановить базу из бэкапов")
+    restore_parser.add_argument("--until", help="восстановить до указанного файла цепочки включительно")
+    args = parser.parse_args()
+
+    if args.command == "restore":
+        try:
+            restore(args.data, args.dir, args.until)
+        except (FileNotFoundError, ValueError) as e:
+            parser.error(str(e))
+    else:
+        backup(args.data, args.dir, incremental=args.command == "incremental")
+
+if __name__ == "__main__":
+    main()
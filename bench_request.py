@@ -0,0 +1,163 @@
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from telegram import Bot
+from telegram.error import TimedOut
+from telegram.request import HTTPXRequest
+from main import make_request, POOL_SIZE
+
+# Бенчмарк HTTP-клиента Bot API против локального фейкового сервера.
+# Сравнивает настройки HTTPXRequest по умолчанию с make_request() из main.py на сетке
+# распределений: задержка ответа логнормальная (медиана --latency, разброс --sigma),
+# паузы между пачками запросов экспоненциальные со средним --idle.
+# Клиент "pool" — пул и keep-alive из make_request(), но read timeout как у PTB по умолчанию (5 с),
+# поэтому разница default/pool — это пул, а pool/tuned — только READ_TIMEOUT.
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+TOKEN = "123456:FAKE"
+
+PTB_READ_TIMEOUT = 5.0  # read timeout HTTPXRequest по умолчанию
+
+# Минимальный HTTP/1.1 сервер с keep-alive, отвечающий как sendMessage
+class FakeBotAPI:
+    def __init__(self, latency, sigma, handshake, connections):
+        self.latency = latency
+        self.sigma = sigma
+        self.handshake = handshake
+        self.connections = connections
+        self.message_id = 0
+
+    async def handle(self, reader, writer):
+        with self.connections.get_lock():
+            self.connections.value += 1
+        # Имитация TCP+TLS рукопожатия на каждое новое соединение
+        await asyncio.sleep(self.handshake)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.decode("latin-1").split("\r\n"):
+                    if line.lower().startswith("content-length:"):
+                        length = int(line.split(":", 1)[1])
+                if length:
+                    await reader.readexactly(length)
+                method = head.split(b" ", 2)[1].rsplit(b"/", 1)[-1]
+                if method == b"getMe":
+                    result = {"id": 1, "is_bot": True, "first_name": "TimeQuest", "username": "timequest_bench_bot"}
+                else:
+                    self.message_id += 1
+                    if self.latency:
+                        await asyncio.sleep(random.lognormvariate(math.log(self.latency), self.sigma))
+                    result = {
+                        "message_id": self.message_id,
+                        "date": int(time.time()),
+                        "chat": {"id": 1, "type": "private"},
+                        "text": "ok",
+                    }
+                body = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Connection: keep-alive\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port, ready):
+        server = await asyncio.start_server(self.handle, "127.0.0.1", port)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+# Сервер работает в отдельном процессе, чтобы не делить CPU с измеряемым клиентом
+def run_server(api, port, ready):
+    random.seed(0)
+    asyncio.run(api.serve(port, ready))
+
+async def run_scenario(request, port, connections, concurrency, rounds, idle, seed):
+    bot = Bot(TOKEN, base_url=f"http://127.0.0.1:{port}/bot", request=request)
+    await bot.initialize()
+    with connections.get_lock():
+        connections.value = 0
+    latencies = []
+    timeouts = 0
+    pauses = random.Random(seed)  # Одинаковые паузы для всех клиентов
+
+    async def one():
+        nonlocal timeouts
+        start = time.perf_counter()
+        try:
+            await bot.send_message(chat_id=1, text="bench")
+            latencies.append(time.perf_counter() - start)
+        except TimedOut:
+            timeouts += 1
+
+    for i in range(rounds):
+        await asyncio.gather(*(one() for _ in range(concurrency)))
+        if i < rounds - 1:
+            await asyncio.sleep(pauses.expovariate(1 / idle))
+    await bot.shutdown()
+
+    latencies.sort()
+    total = concurrency * rounds
+    return {
+        "p50": latencies[len(latencies) // 2] * 1000 if latencies else 0,
+        "p95": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0,
+        "timeouts": timeouts / total,
+        "connections": connections.value,
+    }
+
+def floats(value):
+    return [float(item) for item in value.split(",")]
+
+async def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк HTTP-клиента Bot API: сетка распределений задержки и пауз")
+    parser.add_argument("--concurrency", type=int, default=POOL_SIZE, help="одновременных запросов в пачке")
+    parser.add_argument("--rounds", type=int, default=5, help="пачек запросов на прогон")
+    parser.add_argument("--idle", type=floats, default=[0.5, 3.0, 10.0], help="средние паузы между пачками, с (через запятую)")
+    parser.add_argument("--latency", type=float, default=0.1, help="медиана задержки ответа, с")
+    parser.add_argument("--sigma", type=floats, default=[0.5, 1.0, 1.5], help="разброс логнормальной задержки (через запятую)")
+    parser.add_argument("--handshake", type=float, default=0.1, help="стоимость нового соединения, с")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+
+    clients = {
+        "default": lambda: HTTPXRequest(),
+        "pool": lambda: make_request(POOL_SIZE, read_timeout=PTB_READ_TIMEOUT),
+        "tuned": lambda: make_request(POOL_SIZE),
+    }
+    print(f"медиана задержки {args.latency * 1000:.0f} мс, рукопожатие {args.handshake * 1000:.0f} мс, {args.concurrency} запросов x {args.rounds} пачек")
+    print(f"{'sigma':>5} {'p99 API':>8} {'idle':>5}  {'клиент':<8} {'p50 мс':>8} {'p95 мс':>8} {'тайм-ауты':>9} {'соединений':>10}")
+    for sigma in args.sigma:
+        # Теоретический p99 задержки сервера для этого разброса
+        p99 = args.latency * math.exp(2.326 * sigma)
+        connections = multiprocessing.Value("i", 0)
+        ready = multiprocessing.Event()
+        api = FakeBotAPI(args.latency, sigma, args.handshake, connections)
+        server = multiprocessing.Process(target=run_server, args=(api, args.port, ready), daemon=True)
+        server.start()
+        ready.wait()
+        try:
+            for idle in args.idle:
+                for name, make_client in clients.items():
+                    result = await run_scenario(make_client(), args.port, connections, args.concurrency, args.rounds, idle, args.seed)
+                    print(
+                        f"{sigma:>5.2f} {p99:>7.2f}с {idle:>5.1f}  {name:<8} {result['p50']:>8.1f} {result['p95']:>8.1f} "
+                        f"{result['timeouts']:>9.1%} {result['connections']:>10}", flush=True,
+                    )
+        finally:
+            server.terminate()
+            server.join()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import main
+from bench_request import FakeBotAPI, run_server
+
+# Память на тенанта: N ботов в одном процессе (main.start_tenants) против N процессов по одному боту.
+# Боты поднимаются против локального фейкового Bot API, без long polling.
+logging.getLogger("main").setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+def rss_kb():
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+def make_hero(i):
+    return {
+        "name": f"hero{i}", "class": "Knight", "level": 1 + i % 10, "exp": i % 100, "coins": i % 500,
+        "energy": 100, "inventory": ["Меч"] * (i % 5), "region": i % 3, "quests_completed": i % 20, "current_quest": None,
+    }
+
+async def worker(tenants_count, heroes, port, offset):
+    workdir = tempfile.mkdtemp(prefix="tq-tenants-")
+    main.DATA_FILE = os.path.join(workdir, "data.json")
+    tenants = {f"t{offset + i}": f"{100000 + offset + i}:FAKE" for i in range(tenants_count)}
+    for tenant in tenants:
+        with open(main.data_file_for(tenant), "w") as f:
+            json.dump({str(i): make_hero(i) for i in range(heroes)}, f)
+    apps = await main.start_tenants(tenants, poll=False, base_url=f"http://127.0.0.1:{port}/bot")
+    print(rss_kb())
+    await main.stop_tenants(apps)
+
+def run_worker(tenants_count, heroes, port, offset=0):
+    output = subprocess.run(
+        [sys.executable, __file__, "--worker", "--tenants", str(tenants_count), "--heroes", str(heroes), "--port", str(port), "--offset", str(offset)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return int(output.strip().splitlines()[-1])
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Память на тенанта: один процесс против процесса на бота")
+    parser.add_argument("--tenants", type=int, default=10)
+    parser.add_argument("--heroes", type=int, default=1000, help="героев у каждого тенанта")
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--offset", type=int, default=0)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        asyncio.run(worker(args.tenants, args.heroes, args.port, args.offset))
+        return
+
+    connections = multiprocessing.Value("i", 0)
+    ready = multiprocessing.Event()
+    api = FakeBotAPI(0.0, 0.0, 0.0, connections)
+    server = multiprocessing.Process(target=run_server, args=(api, args.port, ready), daemon=True)
+    server.start()
+    ready.wait()
+    try:
+        shared = run_worker(args.tenants, args.heroes, args.port)
+        separate = [run_worker(1, args.heroes, args.port, offset=i) for i in range(args.tenants)]
+    finally:
+        server.terminate()
+
+    print(f"Тенантов: {args.tenants}, героев у каждого: {args.heroes}")
+    print(f"Один процесс:       {shared / 1024:8.1f} МБ всего, {shared / 1024 / args.tenants:6.1f} МБ на тенанта")
+    print(f"Процесс на бота:    {sum(separate) / 1024:8.1f} МБ всего, {sum(separate) / 1024 / args.tenants:6.1f} МБ на тенанта")
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,11 +1,24 @@
+import os
+import re
+import sys
 import json
 import asyncio
 import logging
+import time
 import random
-from collections import Counter
+import signal
+import hashlib
+import importlib.util
+import threading
+import traceback
+import contextvars
+from collections import Counter, deque
+from collections.abc import MutableMapping
+import httpx
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.ext import AIORateLimiter, Application, ExtBot, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
 from telegram.error import TimedOut, BadRequest
+from telegram.request import HTTPXRequest
 
 # Настройка логирования
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -13,18 +26,262 @@ logger = logging.getLogger(__name__)
 
 # Хранение данных
 DATA_FILE = "data.json"
-users = {}
+DEFAULT_TENANT = "default"
+# Тенант (бот), чьё обновление сейчас обрабатывается; задаётся в TenantApplication.process_update
+# и наследуется всеми задачами, которые обработчик запускает (квесты, прогресс-бары)
+current_tenant = contextvars.ContextVar("current_tenant", default=DEFAULT_TENANT)
 
-def load_data():
+# Герои с отдельным пространством имён на каждого тенанта.
+# Обработчики работают с `users` как с обычным dict текущего тенанта.
+class TenantUsers(MutableMapping):
+    def __init__(self):
+        self.namespaces = {}
+
+    def namespace(self, tenant=None):
+        return self.namespaces.setdefault(tenant or current_tenant.get(), {})
+
+    def __getitem__(self, user_id):
+        return self.namespace()[user_id]
+
+    def __setitem__(self, user_id, user):
+        self.namespace()[user_id] = user
+
+    def __delitem__(self, user_id):
+        del self.namespace()[user_id]
+
+    def __iter__(self):
+        return iter(self.namespace())
+
+    def __len__(self):
+        return len(self.namespace())
+
+users = TenantUsers()
+
+# Настройки HTTP-клиента Bot API (переопределяются переменными окружения)
+BOT_TOKEN = os.environ.get("TQ_BOT_TOKEN")  # Обязателен, если не задан TQ_TENANTS
+CONCURRENT_UPDATES = int(os.environ.get("TQ_CONCURRENT_UPDATES", "32"))
+# Каждый одновременно работающий обработчик держит не больше одного запроса,
+# поэтому пул по умолчанию равен числу параллельных обновлений
+POOL_SIZE = int(os.environ.get("TQ_POOL_SIZE", str(CONCURRENT_UPDATES)))
+BACKGROUND_POOL_SIZE = int(os.environ.get("TQ_BACKGROUND_POOL_SIZE", "8"))
+CONNECT_TIMEOUT = float(os.environ.get("TQ_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("TQ_READ_TIMEOUT", "10"))
+WRITE_TIMEOUT = float(os.environ.get("TQ_WRITE_TIMEOUT", "10"))
+MEDIA_WRITE_TIMEOUT = float(os.environ.get("TQ_MEDIA_WRITE_TIMEOUT", "30"))
+POOL_TIMEOUT = float(os.environ.get("TQ_POOL_TIMEOUT", "5"))
+KEEPALIVE_EXPIRY = float(os.environ.get("TQ_KEEPALIVE_EXPIRY", "60"))
+HTTP_VERSION = os.environ.get("TQ_HTTP_VERSION", "1.1")
+BASE_URL = os.environ.get("TQ_BASE_URL")  # Например, локальный Bot API сервер
+# Несколько ботов в одном процессе: TQ_TENANTS="имя=токен,имя=токен"
+TENANTS = os.environ.get("TQ_TENANTS")
+SHARED_POOL_SIZE = int(os.environ.get("TQ_SHARED_POOL_SIZE", "0"))  # 0 — POOL_SIZE на каждого тенанта
+RATE_LIMIT = float(os.environ.get("TQ_RATE_LIMIT", "30"))  # Сообщений в секунду на токен бота
+SHARED_RATE_LIMIT = float(os.environ.get("TQ_SHARED_RATE_LIMIT", "0"))  # Общий потолок процесса; 0 — RATE_LIMIT на каждого тенанта
+# Таймаут long polling getUpdates, с (PTB сам прибавляет его к read timeout)
+GET_UPDATES_TIMEOUT = 30
+
+def make_request(pool_size, read_timeout=READ_TIMEOUT, http_version=HTTP_VERSION, request_class=HTTPXRequest):
+    if http_version != "1.1" and importlib.util.find_spec("h2") is None:
+        logger.warning("HTTP/2 требует пакет httpx[http2], используем HTTP/1.1")
+        http_version = "1.1"
+    return request_class(
+        connection_pool_size=pool_size,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=read_timeout,
+        write_timeout=WRITE_TIMEOUT,
+        media_write_timeout=MEDIA_WRITE_TIMEOUT,
+        pool_timeout=POOL_TIMEOUT,
+        http_version=http_version,
+        # Держим все соединения пула живыми, чтобы не платить за TCP+TLS на каждый запрос
+        httpx_kwargs={"limits": httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )},
+    )
+
+# Длительность "минуты" квеста в секундах; при ускоренном воспроизведении трафика меньше 60
+QUEST_SECONDS_PER_MINUTE = float(os.environ.get("TQ_QUEST_SECONDS_PER_MINUTE", "60"))
+QUEST_PROGRESS_INTERVAL = 5  # Не чаще одной правки прогресс-бара за столько секунд
+
+# Случайность боёв и сообщений отдыха. Если задан TQ_RANDOM_SEED, у каждого пользователя
+# свой генератор с зерном от (seed, user_id) — результат не зависит от чередования пользователей
+RANDOM_SEED = os.environ.get("TQ_RANDOM_SEED")
+user_rngs = {}
+
+def user_random(user_id):
+    if RANDOM_SEED is None:
+        return random
+    tenant = current_tenant.get()
+    key = (tenant, user_id)
+    if key not in user_rngs:
+        seed = f"{RANDOM_SEED}:{user_id}" if tenant == DEFAULT_TENANT else f"{RANDOM_SEED}:{tenant}:{user_id}"
+        user_rngs[key] = random.Random(seed)
+    return user_rngs[key]
+
+# Запись входящих обновлений для воспроизведения (replay.py); включается TQ_RECORD_FILE
+RECORD_FILE = os.environ.get("TQ_RECORD_FILE")
+# Секретная соль обязательна: id в Telegram перебираются, и без неё хэши обращаются обратно.
+# В запись соль не пишется — храни её отдельно, она нужна replay.py для копии базы
+RECORD_SALT = os.environ.get("TQ_RECORD_SALT")
+# Служебные тексты, которые нужны для воспроизведения (целиком, плюс "готово" сколько угодно раз);
+# остальной текст пользователей маскируется
+RECORD_KEEP_TEXTS = {"Показать меню"}
+recorder = {"file": None, "started": None}
+
+def anonymize_id(value):
+    if not RECORD_SALT:
+        raise RuntimeError("Для анонимизации нужна TQ_RECORD_SALT")
+    # 7 байт: коллизии id практически исключены, а значение остаётся целым в пределах int64
+    digest = hashlib.sha256(f"{RECORD_SALT}:{value}".encode()).digest()
+    return int.from_bytes(digest[:7], "big") + 1
+
+def anonymize_text(text):
+    if text.startswith("/"):
+        return text.split()[0]  # Только сама команда: в аргументах бывают личные данные (/start <payload>)
+    words = text.lower().replace(",", " ").split()
+    if " ".join(text.split()) in RECORD_KEEP_TEXTS or (words and all(word == "готово" for word in words)):
+        return text
+    return "x" * len(text)
+
+def anonymize(obj, parent=None):
+    if isinstance(obj, dict):
+        result = {}
+        for key, value in obj.items():
+            if key in ("username", "last_name", "phone_number"):
+                continue
+            if key == "first_name":
+                result[key] = "user"
+            elif key == "id" and parent in ("from", "chat", "user", "sender_chat"):
+                result[key] = anonymize_id(value) * (1 if value > 0 else -1)
+            elif key in ("text", "caption") and isinstance(value, str):
+                result[key] = anonymize_text(value)
+            elif key == "entities" and obj.get("text", "").startswith("/"):
+                # Без bot_command при воспроизведении команда придёт как обычный текст
+                result[key] = [entity for entity in value if entity.get("type") == "bot_command" and entity.get("offset") == 0]
+            elif key in ("entities", "caption_entities", "photo"):
+                continue
+            else:
+                result[key] = anonymize(value, key)
+        return result
+    if isinstance(obj, list):
+        return [anonymize(item, parent) for item in obj]
+    return obj
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if recorder["file"] is None:
+        recorder["file"] = open(RECORD_FILE, "a", encoding="utf-8")
+        recorder["started"] = time.monotonic()
+    record = {"t": round(time.monotonic() - recorder["started"], 3), "update": anonymize(update.to_dict())}
+    recorder["file"].write(json.dumps(record, ensure_ascii=False) + "\n")
+    recorder["file"].flush()
+
+# У тенанта по умолчанию прежний data.json, у остальных data.<тенант>.json
+def data_file_for(tenant):
+    if tenant == DEFAULT_TENANT:
+        return DATA_FILE
+    root, ext = os.path.splitext(DATA_FILE)
+    return f"{root}.{tenant}{ext}"
+
+# HTTPXRequest, который делят боты разных тенантов: клиент закрывается, когда его отпустит последний бот
+class SharedHTTPXRequest(HTTPXRequest):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.holders = 0
+
+    async def initialize(self):
+        self.holders += 1
+        await super().initialize()
+
+    async def shutdown(self):
+        self.holders -= 1
+        if self.holders <= 0:
+            await super().shutdown()
+
+    # Закрыть независимо от счётчика (если бот упал посреди initialize и не отпустил клиент)
+    async def close(self):
+        self.holders = 0
+        await super().shutdown()
+
+def load_data(tenant=DEFAULT_TENANT):
     try:
-        with open(DATA_FILE, "r") as f:
+        with open(data_file_for(tenant), "r") as f:
             return json.load(f)
     except FileNotFoundError:
         return {}
 
+# Атомарная запись: сначала во временный файл, затем os.replace.
+# Читатель (например, backup.py), открывший старый файл, дочитает целый снимок.
+# fsync до os.replace: иначе после сбоя питания можно получить пустой data.json.
+def write_data_file(data_file, payload):
+    tmp_file = data_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, data_file)
+
+# Ожидающие записи по файлам: {файл: {"payload": str или None, "task": asyncio.Task, "error": OSError или None}}
+data_writers = {}
+# Повторы неудачной записи: паузы SAVE_RETRY_DELAY, 2x, 4x... не больше SAVE_RETRY_MAX_DELAY.
+# На Windows os.replace падает, пока data.json открыт читателем (например, backup.py).
+SAVE_RETRIES = int(os.environ.get("TQ_SAVE_RETRIES", "8"))
+SAVE_RETRY_DELAY = 0.5
+SAVE_RETRY_MAX_DELAY = 10.0
+
+# Снимок сериализуется сразу (в цикле событий словарь никто не меняет посреди json.dumps),
+# а запись с fsync уходит в поток. На файл работает одна задача-писатель — она же
+# служит блокировкой; сохранения, пришедшие во время записи, схлопываются в последний снимок.
 def save_data():
-    with open(DATA_FILE, "w") as f:
-        json.dump(users, f)
+    tenant = current_tenant.get()
+    data_file = data_file_for(tenant)
+    payload = json.dumps(users.namespace(tenant))
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        write_data_file(data_file, payload)  # Вне цикла событий (скрипты, тесты) пишем сразу
+        return
+    writer = data_writers.setdefault(data_file, {"payload": None, "task": None, "error": None})
+    writer["payload"] = payload
+    start_data_writer(data_file, writer)
+
+def start_data_writer(data_file, writer):
+    if writer["task"] is None or writer["task"].done():
+        writer["task"] = asyncio.create_task(flush_data_file(data_file, writer))
+
+# Снимок, который не удалось записать, остаётся в writer["payload"], если новее не пришло,
+# и пишется повторно с нарастающей паузой. После SAVE_RETRIES попыток ошибка остаётся в writer["error"]
+async def flush_data_file(data_file, writer):
+    failures = 0
+    while writer["payload"] is not None:
+        payload, writer["payload"] = writer["payload"], None
+        try:
+            await asyncio.to_thread(write_data_file, data_file, payload)
+            failures = 0
+            writer["error"] = None
+        except OSError as e:
+            if writer["payload"] is None:
+                writer["payload"] = payload
+            writer["error"] = e
+            if failures >= SAVE_RETRIES:
+                logger.error(f"Не удалось сохранить {data_file} за {failures + 1} попыток: {e}")
+                return
+            delay = min(SAVE_RETRY_MAX_DELAY, SAVE_RETRY_DELAY * 2 ** failures)
+            failures += 1
+            logger.warning(f"Не удалось сохранить {data_file}: {e}. Повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+# Дописать всё, что ждёт записи (в том числе после исчерпанных повторов); итоговую ошибку не прячем
+async def flush_pending_writes():
+    for data_file, writer in data_writers.items():
+        if writer["payload"] is not None:
+            start_data_writer(data_file, writer)
+    tasks = [writer["task"] for writer in data_writers.values() if writer["task"] and not writer["task"].done()]
+    if tasks:
+        await asyncio.gather(*tasks)
+    failed = [data_file for data_file, writer in data_writers.items() if writer["payload"] is not None]
+    if failed:
+        raise OSError(f"Изменения не сохранены в {', '.join(failed)}: {data_writers[failed[0]]['error']}")
 
 # Динамическое главное меню
 def get_main_menu(user_id):
@@ -67,11 +324,64 @@ SHOP_MENU = InlineKeyboardMarkup([
 # Текстовая клавиатура с кнопкой "Показать меню"
 SHOW_MENU_KEYBOARD = ReplyKeyboardMarkup([[KeyboardButton("Показать меню")]], resize_keyboard=True, one_time_keyboard=False)
 
+# Защита от многократных нажатий: одинаковые callback'и одного пользователя, пока первый
+# ещё выполняется, схлопываются в одно выполнение, а повторы в окне debounce отбрасываются.
+# И то и другое — только если повтор совпадает с последним нажатием пользователя:
+# status -> inventory -> status должен снова показать статус
+DEFAULT_DEBOUNCE_WINDOW = float(os.environ.get("TQ_DEBOUNCE_WINDOW", "0.5"))
+DEBOUNCE_WINDOWS = {
+    "fight": 2.0,
+    "rest": 1.5,
+    "status": 1.0,
+    "inventory": 1.0,
+    "map": 1.0,
+    "shop": 1.0,
+    "description": 1.0,
+    "buy_potion": 1.0,
+    "buy_super_sword": 1.0,
+}
+inflight_callbacks = set()  # (тенант, user_id, data) выполняющихся callback'ов
+last_callback = {}  # (тенант, user_id) -> (data, время завершения или None, пока выполняется)
+callback_stats = Counter()  # runs, coalesced, debounced, api_calls_saved
+route_api_calls = Counter()  # route -> вызовов Bot API за все выполнения
+route_runs = Counter()  # route -> выполнений
+current_route = contextvars.ContextVar("current_route", default=None)
+
+# Маршруты для счётчиков: callback_data присылает клиент, поэтому в ключи идут только известные значения
+CALLBACK_ROUTES = {
+    "create", "edit_hero", "quest", "inventory", "map", "status", "rest", "shop", "fight",
+    "description", "buy_potion", "buy_super_sword", "back_to_menu",
+}
+CALLBACK_ROUTE_PREFIXES = ("class_", "difficulty_")
+
+def callback_route(data):
+    if data in CALLBACK_ROUTES:
+        return data
+    for prefix in CALLBACK_ROUTE_PREFIXES:
+        if data.startswith(prefix):
+            return prefix + "*"
+    return "unknown"
+
+def callback_report():
+    return {
+        "runs": callback_stats["runs"],
+        "coalesced": callback_stats["coalesced"],
+        "debounced": callback_stats["debounced"],
+        "api_calls_saved": round(callback_stats["api_calls_saved"], 1),
+    }
+
+# Учёт вызовов Bot API для текущего маршрута callback'а
+def count_api_call():
+    route = current_route.get()
+    if route:
+        route_api_calls[route] += 1
+
 # Функция для отправки сообщения с повторными попытками
 async def send_with_retry(bot, chat_id, text, reply_markup=None, parse_mode=None, retries=3, delay=1):
     for attempt in range(retries):
         try:
             logger.info(f"Попытка {attempt + 1} отправить сообщение: {text[:50]}...")
+            count_api_call()
             msg = await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
             logger.info("Сообщение успешно отправлено.")
             return msg
@@ -88,6 +398,7 @@ async def edit_with_retry(bot, chat_id, message_id, text, reply_markup=None, par
     for attempt in range(retries):
         try:
             logger.info(f"Попытка {attempt + 1} отредактировать сообщение: {text[:50]}...")
+            count_api_call()
             await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
             logger.info("Сообщение успешно отредактировано.")
             return True
@@ -114,6 +425,7 @@ async def send_photo_with_retry(bot, chat_id, photo, caption=None, reply_markup=
     for attempt in range(retries):
         try:
             logger.info(f"Попытка {attempt + 1} отправить фото в чат {chat_id}...")
+            count_api_call()
             msg = await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, reply_markup=reply_markup)
             logger.info("Фото успешно отправлено.")
             return msg
@@ -193,13 +505,10 @@ async def description(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Создание героя
 async def create(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
     chat_id = update.effective_chat.id
     user_id = str(update.effective_user.id)
     last_message_id = context.user_data.get("last_message_id")
     
-    await query.answer()
-    
     if user_id in users:
         if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, "У тебя уже есть герой! Используй 'Статус' или 'Редактировать героя'.", reply_markup=get_main_menu(user_id)):
             return
@@ -208,23 +517,15 @@ async def create(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data["last_message_id"] = msg.message_id
         return
     
-    if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, "Введи имя героя:", reply_markup=CLASS_MENU):
-        pass
-    else:
-        msg = await send_with_retry(context.bot, chat_id, "Введи имя героя:", reply_markup=CLASS_MENU)
-        if msg:
-            context.user_data["last_message_id"] = msg.message_id
-    context.user_data["awaiting_create_name"] = True
+    await reply(context, chat_id, "Введи имя героя:", reply_markup=CLASS_MENU)
+    set_state(context, "create_name")
 
 # Редактирование героя
 async def edit_hero(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
     chat_id = update.effective_chat.id
     user_id = str(update.effective_user.id)
     last_message_id = context.user_data.get("last_message_id")
     
-    await query.answer()
-    
     if user_id not in users:
         if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, "Сначала создай героя!", reply_markup=get_main_menu(user_id)):
             return
@@ -233,23 +534,15 @@ async def edit_hero(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data["last_message_id"] = msg.message_id
         return
     
-    if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, "Введи новое имя героя:", reply_markup=CLASS_MENU):
-        pass
-    else:
-        msg = await send_with_retry(context.bot, chat_id, "Введи новое имя героя:", reply_markup=CLASS_MENU)
-        if msg:
-            context.user_data["last_message_id"] = msg.message_id
-    context.user_data["awaiting_edit_name"] = True
+    await reply(context, chat_id, "Введи новое имя героя:", reply_markup=CLASS_MENU)
+    set_state(context, "edit_name")
 
 # Новая миссия
 async def quest(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
     chat_id = update.effective_chat.id
     user_id = str(update.effective_user.id)
     last_message_id = context.user_data.get("last_message_id")
     
-    await query.answer()
-    
     if user_id not in users:
         if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, "Сначала создай героя!", reply_markup=get_main_menu(user_id)):
             return
@@ -265,22 +558,15 @@ async def quest(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data["last_message_id"] = msg.message_id
         return
     
-    if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, "Введи задачу (например, 'Написать код'):", reply_markup=SHOW_MENU_KEYBOARD):
-        pass
-    else:
-        msg = await send_with_retry(context.bot, chat_id, "Введи задачу (например, 'Написать код'):", reply_markup=SHOW_MENU_KEYBOARD)
-        if msg:
-            context.user_data["last_message_id"] = msg.message_id
-    context.user_data["awaiting_quest_text"] = True
+    await reply(context, chat_id, "Введи задачу (например, 'Написать код'):", reply_markup=SHOW_MENU_KEYBOARD)
+    set_state(context, "quest_text")
 
 # Инвентарь
 async def inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
     chat_id = update.effective_chat.id
     user_id = str(update.effective_user.id)
     last_message_id = context.user_data.get("last_message_id")
     
-    await query.answer()
     logger.info(f"Кнопка 'Инвентарь' нажата пользователем {user_id}")
     
     if user_id not in users:
@@ -305,12 +591,10 @@ async def inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Карта
 async def map(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
     chat_id = update.effective_chat.id
     user_id = str(update.effective_user.id)
     last_message_id = context.user_data.get("last_message_id")
     
-    await query.answer()
     logger.info(f"Кнопка 'Карта' нажата пользователем {user_id}")
     
     if user_id not in users:
@@ -330,12 +614,10 @@ async def map(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Статус
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
     chat_id = update.effective_chat.id
     user_id = str(update.effective_user.id)
     last_message_id = context.user_data.get("last_message_id")
     
-    await query.answer()
     logger.info(f"Кнопка 'Статус' нажата пользователем {user_id}")
     
     if user_id not in users:
@@ -363,12 +645,10 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Магазин
 async def shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
     chat_id = update.effective_chat.id
     user_id = str(update.effective_user.id)
     last_message_id = context.user_data.get("last_message_id")
     
-    await query.answer()
     logger.info(f"Кнопка 'Магазин' нажата пользователем {user_id}")
     
     if user_id not in users:
@@ -395,12 +675,10 @@ async def shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Сражение с монстрами
 async def fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
     chat_id = update.effective_chat.id
     user_id = str(update.effective_user.id)
     last_message_id = context.user_data.get("last_message_id")
     
-    await query.answer()
     logger.info(f"Кнопка 'Сразиться' нажата пользователем {user_id}")
     
     if user_id not in users:
@@ -411,12 +689,13 @@ async def fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data["last_message_id"] = msg.message_id
         return
     
+    rng = user_random(user_id)
     monsters = [
         ("Гоблин", 10, 70, (5, 5, None)),
         ("Орк", 20, 50, (15, 10, None)),
-        ("Дракон", 40, 30, (50, 25, "Драконий клык" if random.random() < 0.3 else None))
+        ("Дракон", 40, 30, (50, 25, "Драконий клык" if rng.random() < 0.3 else None))
     ]
-    monster = random.choice(monsters)
+    monster = rng.choice(monsters)
     monster_name, energy_cost, base_win_chance, (coins_reward, exp_reward, item_reward) = monster
     
     if users[user_id]["energy"] < energy_cost:
@@ -429,7 +708,7 @@ async def fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     win_chance = min(95, base_win_chance + 5 * (users[user_id]["level"] - 1))
     users[user_id]["energy"] -= energy_cost
-    fight_result = random.random() * 100 < win_chance
+    fight_result = rng.random() * 100 < win_chance
     
     if fight_result:
         users[user_id]["coins"] += coins_reward
@@ -454,12 +733,10 @@ async def fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Функция отдыха
 async def rest(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
     chat_id = update.effective_chat.id
     user_id = str(update.effective_user.id)
     last_message_id = context.user_data.get("last_message_id")
     
-    await query.answer()
     logger.info(f"Кнопка 'Отдых' нажата пользователем {user_id}")
     
     if user_id not in users:
@@ -469,28 +746,198 @@ async def rest(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if msg:
             context.user_data["last_message_id"] = msg.message_id
         return
-    if "rest_count" in context.user_data:
-        if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, f"Ты уже отдыхаешь! Напиши 'готово' ещё {5 - context.user_data['rest_count']} раз.", reply_markup=get_main_menu(user_id)):
+    if get_state(context) == "rest":
+        if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, f"Ты уже отдыхаешь! Напиши 'готово' ещё {REST_STEPS - context.user_data['rest_count']} раз.", reply_markup=get_main_menu(user_id)):
             return
-        msg = await send_with_retry(context.bot, chat_id, f"Ты уже отдыхаешь! Напиши 'готово' ещё {5 - context.user_data['rest_count']} раз.", reply_markup=get_main_menu(user_id))
+        msg = await send_with_retry(context.bot, chat_id, f"Ты уже отдыхаешь! Напиши 'готово' ещё {REST_STEPS - context.user_data['rest_count']} раз.", reply_markup=get_main_menu(user_id))
         if msg:
             context.user_data["last_message_id"] = msg.message_id
         return
     
-    if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, "Твой герой устал! Напиши 'готово' 5 раз для восстановления энергии.", reply_markup=SHOW_MENU_KEYBOARD):
-        pass
-    else:
-        msg = await send_with_retry(context.bot, chat_id, "Твой герой устал! Напиши 'готово' 5 раз для восстановления энергии.", reply_markup=SHOW_MENU_KEYBOARD)
-        if msg:
-            context.user_data["last_message_id"] = msg.message_id
-    context.user_data["rest_count"] = 0
+    await reply(context, chat_id, f"Твой герой устал! Напиши 'готово' {REST_STEPS} раз (можно в одном сообщении) для восстановления энергии.", reply_markup=SHOW_MENU_KEYBOARD)
+    set_state(context, "rest", rest_count=0)
+
+# Конечный автомат текстовых диалогов.
+# Состояние и его данные лежат в user_data: "state", "state_since" и поля конкретного диалога.
+# Переходы по тексту (TEXT_TRANSITIONS) и по инлайн-кнопкам (CALLBACK_TRANSITIONS) —
+# функции (user_data, user_id, ввод) -> (ответ, клавиатура), их можно прогонять без Telegram.
+REST_STEPS = 5
+STATE_TIMEOUTS = {
+    "create_name": 600,
+    "create_class": 600,
+    "edit_name": 600,
+    "edit_class": 600,
+    "quest_text": 600,
+    "quest_difficulty": 600,
+    "rest": 1800,
+}
+STATE_DATA_KEYS = ("hero_name", "quest_text", "rest_count")
+STATE_SWEEP_INTERVAL = 60
+
+REST_MESSAGES = [
+    "Ещё {remaining} трав, и герой скажет 'Уф, устал!' Пиши 'готово'!",
+    "Собери ещё {remaining} трав, не ленись, как дракон! 'Готово' в помощь.",
+    "Осталось {remaining} трав до эпичного отдыха, давай 'готово'!",
+    "Герой просит ещё {remaining} трав, пиши 'готово', не зевай!",
+    "Травы ждут: ещё {remaining} раз 'готово', и ты мастер отдыха!",
+    "Ещё {remaining} трав до победы над усталостью, пиши 'готово'!",
+    "Только {remaining} трав отделяют тебя от релакса, давай 'готово'!",
+    "Собери ещё {remaining} трав, или герой начнёт ныть! Пиши 'готово'.",
+    "Осталось {remaining} трав — 'готово', и энергия в кармане!",
+    "Ещё {remaining} 'готово', и травы скажут тебе спасибо!"
+]
+REST_ERROR_MESSAGES = [
+    "Эй, это не заклинание 'готово'! Попробуй ещё раз.",
+    "Ну ты даёшь! Герои так не пишут, давай 'готово'!",
+    "Что-то твои травы не собрались, пиши 'готово' точнее!",
+    "Твой герой в шоке: это не 'готово', пробуй снова!",
+    "Ой, не туда пальцем попал! Пиши 'готово', чемпион.",
+    "Травы смеются над тобой! Давай 'готово' как надо.",
+    "Не-а, это не пароль от сокровищ! Пиши 'готово'.",
+    "Герой устал от ошибок, давай 'готово' без фокусов!",
+    "Ты что, траву пугаешь? Пиши 'готово', не стесняйся.",
+    "Это не эпичное заклинание! 'Готово' — вот что нужно."
+]
+
+def clear_state(user_data):
+    user_data.pop("state", None)
+    user_data.pop("state_since", None)
+    for key in STATE_DATA_KEYS:
+        user_data.pop(key, None)
+
+def state_expired(user_data, now):
+    state = user_data.get("state")
+    return state is not None and now - user_data.get("state_since", now) > STATE_TIMEOUTS.get(state, 0)
+
+# Каждый переход заново отсчитывает тайм-аут нового состояния
+def enter_state(user_data, state, **data):
+    user_data["state"] = state
+    user_data["state_since"] = time.monotonic()
+    user_data.update(data)
+
+def set_state(context, state, **data):
+    enter_state(context.user_data, state, **data)
+
+def get_state(context):
+    if state_expired(context.user_data, time.monotonic()):
+        logger.info(f"Диалог '{context.user_data['state']}' истёк по тайм-ауту")
+        clear_state(context.user_data)
+    return context.user_data.get("state")
+
+def on_create_name(user_data, user_id, text):
+    enter_state(user_data, "create_class", hero_name=text)
+    return f"Имя: {text}\nВыбери класс:", CLASS_MENU
+
+def on_edit_name(user_data, user_id, text):
+    enter_state(user_data, "edit_class", hero_name=text)
+    return f"Новое имя: {text}\nВыбери новый класс:", CLASS_MENU
+
+def on_quest_text(user_data, user_id, text):
+    enter_state(user_data, "quest_difficulty", quest_text=text)
+    return "Выбери сложность квеста:", DIFFICULTY_MENU
+
+# "готово" можно написать несколько раз в одном сообщении — меньше обменов сообщениями
+def on_rest(user_data, user_id, text):
+    words = text.lower().replace(",", " ").split()
+    if not words or any(word != "готово" for word in words):
+        return user_random(user_id).choice(REST_ERROR_MESSAGES), SHOW_MENU_KEYBOARD
+    enter_state(user_data, "rest", rest_count=user_data["rest_count"] + len(words))
+    if user_data["rest_count"] >= REST_STEPS:
+        clear_state(user_data)
+        users[user_id]["energy"] = min(100, users[user_id]["energy"] + 20)
+        save_data()
+        return f"Травы собраны! Энергия: {users[user_id]['energy']}", get_main_menu(user_id)
+    remaining = REST_STEPS - user_data["rest_count"]
+    return user_random(user_id).choice(REST_MESSAGES).format(remaining=remaining), SHOW_MENU_KEYBOARD
+
+TEXT_TRANSITIONS = {
+    "create_name": on_create_name,
+    "edit_name": on_edit_name,
+    "quest_text": on_quest_text,
+    "rest": on_rest,
+}
+
+def on_create_class(user_data, user_id, class_name):
+    name = user_data["hero_name"]
+    clear_state(user_data)
+    users[user_id] = {
+        "name": name,
+        "class": class_name,
+        "level": 1,
+        "exp": 0,
+        "coins": 0,
+        "energy": 100,
+        "inventory": [],
+        "region": 0,
+        "quests_completed": 0,
+        "current_quest": None
+    }
+    save_data()
+    return f"Герой {name} ({class_name}) создан!", get_main_menu(user_id)
+
+def on_edit_class(user_data, user_id, class_name):
+    name = user_data["hero_name"]
+    clear_state(user_data)
+    users[user_id]["name"] = name
+    users[user_id]["class"] = class_name
+    save_data()
+    return f"Герой изменён: {name} ({class_name})!", get_main_menu(user_id)
+
+# Выбор сложности только записывает квест в героя; ждёт его конца фоновая задача
+def on_quest_difficulty(user_data, user_id, difficulty):
+    description_text = user_data.get("quest_text", "Безымянная задача")
+    clear_state(user_data)
+    time = {"Easy": 15, "Medium": 30, "Hard": 60}[difficulty]
+    exp = {"Easy": 10, "Medium": 25, "Hard": 50}[difficulty]
+    title = f"Победить дракона {description_text}"
+    if users[user_id]["current_quest"]:
+        return "У тебя уже есть квест!", get_main_menu(user_id)
+    if users[user_id]["energy"] < time:
+        return f"Недостаточно энергии ({users[user_id]['energy']}/{time})! Используй 'Отдых'.", get_main_menu(user_id)
+    users[user_id]["current_quest"] = {"title": title, "time": time, "exp": exp}
+    users[user_id]["energy"] -= time
+    return f"Квест: {title}\nОсталось: {time:02d}:00\nПрогресс: [          ] 0%", None
+
+# Переходы по нажатию инлайн-кнопки: состояние -> (префикс callback_data, переход).
+# Переход получает callback_data без префикса, например "Knight" или "Easy".
+CALLBACK_TRANSITIONS = {
+    "create_class": ("class_", on_create_class),
+    "edit_class": ("class_", on_edit_class),
+    "quest_difficulty": ("difficulty_", on_quest_difficulty),
+}
+
+# Ответ за один вызов API: редактировать можно только с инлайн-клавиатурой,
+# для текстовой клавиатуры сразу отправляем новое сообщение
+async def reply(context, chat_id, text, reply_markup=None, parse_mode=None):
+    last_message_id = context.user_data.get("last_message_id")
+    if last_message_id and not isinstance(reply_markup, ReplyKeyboardMarkup):
+        if await edit_with_retry(context.bot, chat_id, last_message_id, text, reply_markup=reply_markup, parse_mode=parse_mode):
+            return
+    msg = await send_with_retry(context.bot, chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+    if msg:
+        context.user_data["last_message_id"] = msg.message_id
+
+def expire_states(user_datas, now):
+    expired = 0
+    for user_data in user_datas:
+        if state_expired(user_data, now):
+            clear_state(user_data)
+            expired += 1
+    return expired
+
+# Периодическая очистка брошенных диалогов
+async def sweep_expired_states(app: Application):
+    while True:
+        await asyncio.sleep(STATE_SWEEP_INTERVAL)
+        expired = expire_states(app.user_data.values(), time.monotonic())
+        if expired:
+            logger.info(f"Очищено брошенных диалогов: {expired}")
 
 # Обработка текстовых сообщений
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
     text = update.message.text.strip()
     chat_id = update.message.chat_id
-    last_message_id = context.user_data.get("last_message_id")
 
     logger.info(f"Получено текстовое сообщение от {user_id}: {text}")
 
@@ -498,7 +945,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if users.get(user_id, {}).get("current_quest"):
             quest = users[user_id]["current_quest"]
             elapsed = asyncio.get_event_loop().time() - context.user_data.get("quest_start_time", asyncio.get_event_loop().time())
-            total_seconds = quest["time"] * 60
+            total_seconds = quest["time"] * QUEST_SECONDS_PER_MINUTE
             remaining = total_seconds - elapsed
             progress_percent = min(100, int((elapsed / total_seconds) * 100))
             bar_length = 10
@@ -517,92 +964,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 context.user_data["last_message_id"] = msg.message_id
         return
     
-    if context.user_data.get("awaiting_create_name"):
-        context.user_data["hero_name"] = text
-        context.user_data["awaiting_create_name"] = False
-        if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, f"Имя: {text}\nВыбери класс:", reply_markup=CLASS_MENU):
-            return
-        msg = await send_with_retry(context.bot, chat_id, f"Имя: {text}\nВыбери класс:", reply_markup=CLASS_MENU)
-        if msg:
-            context.user_data["last_message_id"] = msg.message_id
-        return
-    
-    if context.user_data.get("awaiting_edit_name"):
-        context.user_data["hero_name"] = text
-        context.user_data["awaiting_edit_name"] = False
-        if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, f"Новое имя: {text}\nВыбери новый класс:", reply_markup=CLASS_MENU):
-            return
-        msg = await send_with_retry(context.bot, chat_id, f"Новое имя: {text}\nВыбери новый класс:", reply_markup=CLASS_MENU)
-        if msg:
-            context.user_data["last_message_id"] = msg.message_id
-        return
-    
-    if context.user_data.get("awaiting_quest_text"):
-        context.user_data["quest_text"] = text
-        context.user_data["awaiting_quest_text"] = False
-        if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, "Выбери сложность квеста:", reply_markup=DIFFICULTY_MENU):
-            return
-        msg = await send_with_retry(context.bot, chat_id, "Выбери сложность квеста:", reply_markup=DIFFICULTY_MENU)
-        if msg:
-            context.user_data["last_message_id"] = msg.message_id
+    state = get_state(context)
+    transition = TEXT_TRANSITIONS.get(state)
+    if not transition:
         return
-    
-    if "rest_count" in context.user_data:
-        if text.lower() == "готово":
-            context.user_data["rest_count"] += 1
-            if context.user_data["rest_count"] >= 5:
-                users[user_id]["energy"] = min(100, users[user_id]["energy"] + 20)
-                if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, f"Травы собраны! Энергия: {users[user_id]['energy']}", reply_markup=get_main_menu(user_id)):
-                    del context.user_data["rest_count"]
-                    return
-                msg = await send_with_retry(context.bot, chat_id, f"Травы собраны! Энергия: {users[user_id]['energy']}", reply_markup=get_main_menu(user_id))
-                if msg:
-                    context.user_data["last_message_id"] = msg.message_id
-                del context.user_data["rest_count"]
-            else:
-                remaining = 5 - context.user_data["rest_count"]
-                rest_messages = [
-                    f"Ещё {remaining} трав, и герой скажет 'Уф, устал!' Пиши 'готово'!",
-                    f"Собери ещё {remaining} трав, не ленись, как дракон! 'Готово' в помощь.",
-                    f"Осталось {remaining} трав до эпичного отдыха, давай 'готово'!",
-                    f"Герой просит ещё {remaining} трав, пиши 'готово', не зевай!",
-                    f"Травы ждут: ещё {remaining} раз 'готово', и ты мастер отдыха!",
-                    f"Ещё {remaining} трав до победы над усталостью, пиши 'готово'!",
-                    f"Только {remaining} трав отделяют тебя от релакса, давай 'готово'!",
-                    f"Собери ещё {remaining} трав, или герой начнёт ныть! Пиши 'готово'.",
-                    f"Осталось {remaining} трав — 'готово', и энергия в кармане!",
-                    f"Ещё {remaining} 'готово', и травы скажут тебе спасибо!"
-                ]
-                if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, random.choice(rest_messages), reply_markup=SHOW_MENU_KEYBOARD):
-                    return
-                msg = await send_with_retry(context.bot, chat_id, random.choice(rest_messages), reply_markup=SHOW_MENU_KEYBOARD)
-                if msg:
-                    context.user_data["last_message_id"] = msg.message_id
-        else:
-            error_messages = [
-                "Эй, это не заклинание 'готово'! Попробуй ещё раз.",
-                "Ну ты даёшь! Герои так не пишут, давай 'готово'!",
-                "Что-то твои травы не собрались, пиши 'готово' точнее!",
-                "Твой герой в шоке: это не 'готово', пробуй снова!",
-                "Ой, не туда пальцем попал! Пиши 'готово', чемпион.",
-                "Травы смеются над тобой! Давай 'готово' как надо.",
-                "Не-а, это не пароль от сокровищ! Пиши 'готово'.",
-                "Герой устал от ошибок, давай 'готово' без фокусов!",
-                "Ты что, траву пугаешь? Пиши 'готово', не стесняйся.",
-                "Это не эпичное заклинание! 'Готово' — вот что нужно."
-            ]
-            if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, random.choice(error_messages), reply_markup=SHOW_MENU_KEYBOARD):
-                return
-            msg = await send_with_retry(context.bot, chat_id, random.choice(error_messages), reply_markup=SHOW_MENU_KEYBOARD)
-            if msg:
-                context.user_data["last_message_id"] = msg.message_id
+    reply_text, reply_markup = transition(context.user_data, user_id, text)
+    await reply(context, chat_id, reply_text, reply_markup=reply_markup)
 
 # Функция для обновления прогресс-бара квеста
 async def update_quest_progress(bot, chat_id, message_id, title, total_time, user_id, context):
+    current_route.set(None)  # Фоновые правки не относятся к callback'у, который запустил задачу
     start_time = asyncio.get_event_loop().time()
     context.user_data["quest_start_time"] = start_time
-    update_interval = 5
-    total_seconds = total_time * 60
+    update_interval = min(QUEST_PROGRESS_INTERVAL, total_time * QUEST_SECONDS_PER_MINUTE / 10)
+    total_seconds = total_time * QUEST_SECONDS_PER_MINUTE
     
     logger.info(f"Запущено обновление прогресс-бара для квеста '{title}' (user_id: {user_id})")
     
@@ -633,8 +1008,52 @@ async def update_quest_progress(bot, chat_id, message_id, title, total_time, use
         
         await asyncio.sleep(update_interval)
 
-# Обработка callback-запросов от инлайн-кнопок
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Фоновые задачи квестов. Ссылки держим сами: цикл событий хранит задачи только слабо
+quest_tasks = set()
+
+def start_quest_task(coro):
+    task = asyncio.create_task(coro)
+    quest_tasks.add(task)
+    task.add_done_callback(quest_tasks.discard)
+    return task
+
+# Квест записан переходом on_quest_difficulty, его сообщение — последний ответ бота.
+# Прогресс-бар и завершение идут в фоне, чтобы обработчик не держал слот concurrent_updates.
+def start_quest(context, chat_id, user_id, current_quest):
+    message_id = context.user_data.get("last_message_id")
+    logger.info(f"Создан квест '{current_quest['title']}' для user_id {user_id}, message_id: {message_id}")
+    if message_id:
+        # Фоновые правки прогресс-бара идут через отдельный пул и не занимают соединения обработчиков
+        background_bot = context.bot_data.get("background_bot", context.bot)
+        start_quest_task(update_quest_progress(background_bot, chat_id, message_id, current_quest["title"], current_quest["time"], user_id, context))
+    start_quest_task(finish_quest(context, chat_id, user_id, message_id, current_quest["time"], current_quest["exp"]))
+
+# Завершение квеста: ждёт его длительность и выдаёт награду
+async def finish_quest(context, chat_id, user_id, last_message_id, time, exp):
+    current_route.set(None)
+    await asyncio.sleep(time * QUEST_SECONDS_PER_MINUTE)  # TQ_QUEST_SECONDS_PER_MINUTE=1 для тестов
+    if users[user_id]["current_quest"]:
+        users[user_id]["exp"] += exp
+        users[user_id]["coins"] += 10
+        users[user_id]["quests_completed"] += 1
+        msg = [f"Победа! +{exp} опыта, +10 монет"]
+        if users[user_id]["exp"] >= users[user_id]["level"] * 10:
+            users[user_id]["level"] += 1
+            msg.append(f"Уровень повышен до {users[user_id]['level']}!")
+        if users[user_id]["quests_completed"] % 5 == 0 and users[user_id]["region"] < 2:
+            users[user_id]["region"] += 1
+            msg.append(f"Новый регион открыт: {['Лес', 'Горы', 'Замок'][users[user_id]['region']]}!")
+        users[user_id]["inventory"].append("Меч")
+        users[user_id]["current_quest"] = None
+        save_data()
+        if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, "\n".join(msg), reply_markup=get_main_menu(user_id)):
+            return
+        msg = await send_with_retry(context.bot, chat_id, "\n".join(msg), reply_markup=get_main_menu(user_id))
+        if msg:
+            context.user_data["last_message_id"] = msg.message_id
+
+# Маршрутизация callback-запросов от инлайн-кнопок
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
     chat_id = query.message.chat_id
@@ -643,49 +1062,26 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     logger.info(f"Получен callback от {user_id}: {data}")
     
+    # Единственный ответ на callback: обработчики меню вызываются и как команды, где query нет
     await query.answer()
     
     if data == "create":
         await create(update, context)
     elif data == "edit_hero":
         await edit_hero(update, context)
-    elif data.startswith("class_"):
-        class_name = data.split("_")[1]
-        if context.user_data.get("hero_name"):
-            name = context.user_data["hero_name"]
-            if "awaiting_create_name" in context.user_data:
-                del context.user_data["awaiting_create_name"]
-                users[user_id] = {
-                    "name": name,
-                    "class": class_name,
-                    "level": 1,
-                    "exp": 0,
-                    "coins": 0,
-                    "energy": 100,
-                    "inventory": [],
-                    "region": 0,
-                    "quests_completed": 0,
-                    "current_quest": None
-                }
-                save_data()
-                del context.user_data["hero_name"]
-                if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, f"Герой {name} ({class_name}) создан!", reply_markup=get_main_menu(user_id)):
-                    return
-                msg = await send_with_retry(context.bot, chat_id, f"Герой {name} ({class_name}) создан!", reply_markup=get_main_menu(user_id))
-                if msg:
-                    context.user_data["last_message_id"] = msg.message_id
-            elif "awaiting_edit_name" in context.user_data:
-                del context.user_data["awaiting_edit_name"]
-                users[user_id]["name"] = name
-                users[user_id]["class"] = class_name
-                save_data()
-                del context.user_data["hero_name"]
-                if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, f"Герой изменён: {name} ({class_name})!", reply_markup=get_main_menu(user_id)):
-                    return
-                msg = await send_with_retry(context.bot, chat_id, f"Герой изменён: {name} ({class_name})!", reply_markup=get_main_menu(user_id))
-                if msg:
-                    context.user_data["last_message_id"] = msg.message_id
-        return
+    elif data.startswith(("class_", "difficulty_")):
+        state = get_state(context)
+        event, transition = CALLBACK_TRANSITIONS.get(state, (None, None))
+        if not transition or not data.startswith(event):
+            logger.info(f"Callback {data} не относится к диалогу '{state}', пропускаем")
+            await reply(context, chat_id, "Этот выбор устарел. Выбери действие:", reply_markup=get_main_menu(user_id))
+            return
+        quest_before = users.get(user_id, {}).get("current_quest")
+        reply_text, reply_markup = transition(context.user_data, user_id, data[len(event):])
+        await reply(context, chat_id, reply_text, reply_markup=reply_markup)
+        current_quest = users.get(user_id, {}).get("current_quest")
+        if current_quest and current_quest is not quest_before:
+            start_quest(context, chat_id, user_id, current_quest)
     elif data == "quest":
         await quest(update, context)
     elif data == "inventory":
@@ -754,53 +1150,6 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg = await send_with_retry(context.bot, chat_id, "Выбери действие:", reply_markup=get_main_menu(user_id))
         if msg:
             context.user_data["last_message_id"] = msg.message_id
-    elif data.startswith("difficulty_"):
-        difficulty = data.split("_")[1]
-        description_text = context.user_data.get("quest_text", "Безымянная задача")
-        time = {"Easy": 15, "Medium": 30, "Hard": 60}[difficulty]
-        exp = {"Easy": 10, "Medium": 25, "Hard": 50}[difficulty]
-        title = f"Победить дракона {description_text}"
-        
-        if users[user_id]["energy"] < time:
-            if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, f"Недостаточно энергии ({users[user_id]['energy']}/{time})! Используй 'Отдых'.", reply_markup=get_main_menu(user_id)):
-                return
-            msg = await send_with_retry(context.bot, chat_id, f"Недостаточно энергии ({users[user_id]['energy']}/{time})! Используй 'Отдых'.", reply_markup=get_main_menu(user_id))
-            if msg:
-                context.user_data["last_message_id"] = msg.message_id
-            return
-        
-        users[user_id]["current_quest"] = {"title": title, "time": time, "exp": exp}
-        users[user_id]["energy"] -= time
-        
-        initial_text = f"Квест: {title}\nОсталось: {time:02d}:00\nПрогресс: [          ] 0%"
-        msg = await send_with_retry(context.bot, chat_id, initial_text)
-        if msg:
-            context.user_data["last_message_id"] = msg.message_id
-            logger.info(f"Создан квест '{title}' для user_id {user_id}, message_id: {msg.message_id}")
-            asyncio.create_task(update_quest_progress(context.bot, chat_id, msg.message_id, title, time, user_id, context))
-        
-        total_seconds = time * 60  # Для реального времени
-        # total_seconds = time  # Uncomment for testing
-        await asyncio.sleep(total_seconds)
-        if users[user_id]["current_quest"]:
-            users[user_id]["exp"] += exp
-            users[user_id]["coins"] += 10
-            users[user_id]["quests_completed"] += 1
-            msg = [f"Победа! +{exp} опыта, +10 монет"]
-            if users[user_id]["exp"] >= users[user_id]["level"] * 10:
-                users[user_id]["level"] += 1
-                msg.append(f"Уровень повышен до {users[user_id]['level']}!")
-            if users[user_id]["quests_completed"] % 5 == 0 and users[user_id]["region"] < 2:
-                users[user_id]["region"] += 1
-                msg.append(f"Новый регион открыт: {['Лес', 'Горы', 'Замок'][users[user_id]['region']]}!")
-            users[user_id]["inventory"].append("Меч")
-            users[user_id]["current_quest"] = None
-            save_data()
-            if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, "\n".join(msg), reply_markup=get_main_menu(user_id)):
-                return
-            msg = await send_with_retry(context.bot, chat_id, "\n".join(msg), reply_markup=get_main_menu(user_id))
-            if msg:
-                context.user_data["last_message_id"] = msg.message_id
     else:
         logger.warning(f"Неизвестный callback: {data}")
         if last_message_id and await edit_with_retry(context.bot, chat_id, last_message_id, "Неизвестное действие. Выбери кнопку ниже.", reply_markup=get_main_menu(user_id)):
@@ -809,6 +1158,54 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if msg:
             context.user_data["last_message_id"] = msg.message_id
 
+# Обработка callback-запросов от инлайн-кнопок с защитой от повторных нажатий
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    data = query.data
+    user_id = str(query.from_user.id)
+    route = callback_route(data)
+    user_key = (current_tenant.get(), user_id)
+    key = user_key + (data,)
+    now = asyncio.get_running_loop().time()
+
+    last_data, last_finished = last_callback.get(user_key, (None, None))
+    if last_data != data:
+        suppressed = None
+    elif key in inflight_callbacks:
+        suppressed = "coalesced"
+    elif last_finished is not None and now - last_finished < DEBOUNCE_WINDOWS.get(route, DEFAULT_DEBOUNCE_WINDOW):
+        suppressed = "debounced"
+    else:
+        suppressed = None
+    if suppressed:
+        callback_stats[suppressed] += 1
+        # Сколько запросов к API сделал бы обработчик: среднее по прошлым выполнениям маршрута
+        runs = route_runs[route]
+        callback_stats["api_calls_saved"] += route_api_calls[route] / runs if runs else 1
+        logger.info(f"Повторный callback {data} от {user_id} пропущен ({suppressed})")
+        await query.answer()
+        return
+
+    inflight_callbacks.add(key)
+    last_callback[user_key] = (data, None)
+    callback_stats["runs"] += 1
+    route_runs[route] += 1
+    token = current_route.set(route)
+    try:
+        count_api_call()  # query.answer() в route_callback
+        await route_callback(update, context)
+    finally:
+        current_route.reset(token)
+        inflight_callbacks.discard(key)
+        finished = asyncio.get_running_loop().time()
+        # Пока этот callback выполнялся, пользователь мог нажать другую кнопку — её не затираем
+        if last_callback.get(user_key, (None,))[0] == data:
+            last_callback[user_key] = (data, finished)
+        if len(last_callback) > 10000:
+            horizon = max(DEBOUNCE_WINDOWS.values(), default=0) + DEFAULT_DEBOUNCE_WINDOW
+            for old_key in [k for k, (_, t) in last_callback.items() if t is not None and finished - t > horizon]:
+                del last_callback[old_key]
+
 # Обработчик ошибок
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     error_msg = str(context.error)
@@ -821,12 +1218,276 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await context.bot.send_message(chat_id=chat_id, text=f"Произошла ошибка: {error_msg}. Попробуй снова.")
 
-# Главная функция
-def main():
-    global users
-    users = load_data()
-    app = Application.builder().token("7525183001:AAET8jlSxnxrldh9I5_lxxC-N7Rj3FpZ8BE").build()  # Замените на новый токен
-    
+# Сторож цикла событий: замер задержки планирования, стек блокирующего вызова и health-эндпоинт
+LAG_CHECK_INTERVAL = float(os.environ.get("TQ_LAG_CHECK_INTERVAL", "0.1"))
+LAG_THRESHOLD = float(os.environ.get("TQ_LAG_THRESHOLD", "0.25"))  # Блокировка дольше — пишем стек
+LAG_READY_THRESHOLD = float(os.environ.get("TQ_LAG_READY_THRESHOLD", "0.2"))  # p95 за окно выше — не готов
+LAG_WINDOW = int(os.environ.get("TQ_LAG_WINDOW", "600"))  # Замеров в окне (~1 минута)
+HEALTH_PORT = os.environ.get("TQ_HEALTH_PORT")
+# По умолчанию только локально; для проверок извне (Kubernetes, балансировщик) TQ_HEALTH_HOST=0.0.0.0
+HEALTH_HOST = os.environ.get("TQ_HEALTH_HOST", "127.0.0.1")
+loop_lag = {"samples": deque(maxlen=LAG_WINDOW), "heartbeat": None, "stalls": 0, "last_stack": None, "holders": 0}
+
+async def measure_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LAG_CHECK_INTERVAL
+        await asyncio.sleep(LAG_CHECK_INTERVAL)
+        loop_lag["samples"].append(max(0.0, loop.time() - expected))
+        loop_lag["heartbeat"] = time.monotonic()
+
+# Поток-наблюдатель: если цикл не отмечался дольше порога, снимаем стек его потока —
+# на вершине будет вызов, который сейчас блокирует (например, json.dumps большой базы или open())
+def watch_loop_thread(loop_thread_id, stop_event):
+    reported = False
+    while not stop_event.wait(LAG_CHECK_INTERVAL):
+        heartbeat = loop_lag["heartbeat"]
+        if heartbeat is None:
+            continue
+        stalled = time.monotonic() - heartbeat - LAG_CHECK_INTERVAL
+        if stalled <= LAG_THRESHOLD:
+            reported = False
+        elif not reported:
+            reported = True
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "стек недоступен"
+            loop_lag["stalls"] += 1
+            loop_lag["last_stack"] = stack
+            logger.warning(f"Цикл событий заблокирован дольше {stalled:.2f} с, стек:\n{stack}")
+
+def loop_lag_percentiles():
+    samples = sorted(loop_lag["samples"])
+    if not samples:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0, "stalls": loop_lag["stalls"]}
+    def pick(q):
+        return round(samples[min(len(samples) - 1, int(len(samples) * q))] * 1000, 1)
+    return {"p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": pick(1.0), "stalls": loop_lag["stalls"]}
+
+# /health — жив ли цикл (ответ приходит только если цикл не заблокирован),
+# /ready — ещё и p95 задержки за окно ниже порога.
+# В теле задержка цикла и счётчики callback'ов (схлопнуто, отброшено, сэкономлено вызовов API)
+async def handle_health(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        path = parts[1].decode("latin-1") if len(parts) > 1 else "/"
+        stats = loop_lag_percentiles()
+        if path == "/health":
+            status = "200 OK"
+        elif path == "/ready":
+            status = "200 OK" if stats["p95_ms"] <= LAG_READY_THRESHOLD * 1000 else "503 Service Unavailable"
+        else:
+            status = "404 Not Found"
+        body = json.dumps(dict(stats, callbacks=callback_report())).encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+# Сторож один на процесс: его запускает первое приложение и останавливает последнее
+async def start_loop_watchdog():
+    loop_lag["holders"] += 1
+    if loop_lag["holders"] > 1:
+        return
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=watch_loop_thread, args=(threading.get_ident(), stop_event), name="loop-watchdog", daemon=True)
+    watcher.start()
+    loop_lag["watchdog"] = (asyncio.create_task(measure_loop_lag()), stop_event)
+    if HEALTH_PORT:
+        loop_lag["health_server"] = await asyncio.start_server(handle_health, HEALTH_HOST, int(HEALTH_PORT))
+        logger.info(f"Health-эндпоинт: {HEALTH_HOST}:{HEALTH_PORT} (/health, /ready)")
+
+async def stop_loop_watchdog():
+    loop_lag["holders"] -= 1
+    if loop_lag["holders"] > 0:
+        return
+    watchdog = loop_lag.pop("watchdog", None)
+    if watchdog:
+        task, stop_event = watchdog
+        task.cancel()
+        stop_event.set()
+    health_server = loop_lag.pop("health_server", None)
+    if health_server:
+        health_server.close()
+        await health_server.wait_closed()
+    logger.info(f"Задержка цикла событий: {loop_lag_percentiles()}")
+
+running_apps = {"holders": 0}
+
+# Отдельный бот с собственным пулом для фоновых запросов.
+# Лимитер тот же, что у основного бота: лимит Telegram считается на токен, а не на пул
+async def post_init(app: Application):
+    background_bot = ExtBot(
+        app.bot.token,
+        base_url=app.bot_data.get("base_url") or "https://api.telegram.org/bot",
+        request=app.bot_data.get("background_request") or make_request(BACKGROUND_POOL_SIZE),
+        rate_limiter=app.bot.rate_limiter,
+    )
+    await background_bot.initialize()
+    app.bot_data["background_bot"] = background_bot
+    app.bot_data["state_sweeper"] = asyncio.create_task(sweep_expired_states(app))
+    running_apps["holders"] += 1
+    await start_loop_watchdog()
+
+# Общее состояние процесса (запись обновлений, отложенные сохранения, статистика callback'ов)
+# закрывает последнее остановленное приложение, как и сторож цикла
+async def post_shutdown(app: Application):
+    state_sweeper = app.bot_data.pop("state_sweeper", None)
+    if state_sweeper:
+        state_sweeper.cancel()
+    background_bot = app.bot_data.pop("background_bot", None)
+    if background_bot:
+        await background_bot.shutdown()
+    running_apps["holders"] -= 1
+    try:
+        if running_apps["holders"] <= 0:
+            logger.info(f"Callback'и: {callback_report()}")
+            if recorder["file"]:
+                recorder["file"].close()
+                recorder["file"] = None
+            await flush_pending_writes()
+    finally:
+        await stop_loop_watchdog()
+
+# Приложение одного тенанта: все обработчики его обновлений (и запущенные ими задачи)
+# видят свой current_tenant, а значит своё пространство героев и свой файл данных
+class TenantApplication(Application):
+    def __init__(self, *, tenant=DEFAULT_TENANT, **kwargs):
+        super().__init__(**kwargs)
+        self.tenant = tenant
+
+    async def process_update(self, update):
+        token = current_tenant.set(self.tenant)
+        try:
+            await super().process_update(update)
+        finally:
+            current_tenant.reset(token)
+
+def build_application(token, tenant=DEFAULT_TENANT, request=None, background_request=None, rate_limiter=None, base_url=BASE_URL):
+    builder = (
+        Application.builder()
+        .application_class(TenantApplication, kwargs={"tenant": tenant})
+        .token(token)
+        .request(request or make_request(POOL_SIZE))
+        .get_updates_request(make_request(1))
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if rate_limiter:
+        builder = builder.rate_limiter(rate_limiter)
+    app = builder.build()
+    app.bot_data["base_url"] = base_url
+    app.bot_data["background_request"] = background_request
+    return app
+
+def parse_tenants(spec):
+    tenants = {}
+    for item in spec.split(","):
+        name, _, token = item.strip().partition("=")
+        if not re.fullmatch(r"[\w-]+", name) or not token:
+            raise ValueError(f"Неверное описание тенанта: {item!r} (нужно имя=токен)")
+        tenants[name] = token
+    return tenants
+
+# Лимит токена (и групп) от AIORateLimiter, а внутри него ещё общий лимит всех тенантов процесса
+class TenantRateLimiter(AIORateLimiter):
+    def __init__(self, shared_limiter, **kwargs):
+        super().__init__(**kwargs)
+        self.shared_limiter = shared_limiter
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if self.shared_limiter is None or data.get("chat_id") is None:
+            return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+
+        async def shared_callback(*call_args, **call_kwargs):
+            async with self.shared_limiter:
+                return await callback(*call_args, **call_kwargs)
+        return await super().process_request(shared_callback, args, kwargs, endpoint, data, rate_limit_args)
+
+# Лимиты отправки; нужен пакет python-telegram-bot[rate-limiter]
+def make_shared_limiter(max_rate):
+    try:
+        from aiolimiter import AsyncLimiter
+    except ImportError:
+        return None
+    return AsyncLimiter(max_rate, 1)
+
+def make_rate_limiter(max_rate, shared_limiter=None):
+    try:
+        return TenantRateLimiter(shared_limiter, overall_max_rate=max_rate, max_retries=2)
+    except RuntimeError:
+        logger.warning("aiolimiter не установлен, лимит отправки отключён")
+        return None
+
+# Запуск нескольких ботов на одном цикле событий с общими пулами соединений и лимитом.
+# Если какой-то тенант не поднялся, уже запущенные останавливаются, а общие пулы закрываются.
+async def start_tenants(tenants, poll=True, base_url=BASE_URL):
+    shared_request = make_request(SHARED_POOL_SIZE or POOL_SIZE * len(tenants), request_class=SharedHTTPXRequest)
+    background_request = make_request(BACKGROUND_POOL_SIZE, request_class=SharedHTTPXRequest)
+    shared_limiter = make_shared_limiter(SHARED_RATE_LIMIT or RATE_LIMIT * len(tenants))
+    apps = []
+    tenant = None
+    try:
+        for tenant, token in tenants.items():
+            users.namespaces[tenant] = load_data(tenant)
+            app = build_application(token, tenant, request=shared_request, background_request=background_request, rate_limiter=make_rate_limiter(RATE_LIMIT, shared_limiter), base_url=base_url)
+            register_handlers(app)
+            await app.initialize()
+            try:
+                await app.post_init(app)
+            except BaseException:
+                await app.shutdown()
+                raise
+            apps.append(app)
+            if poll:
+                await app.updater.start_polling(timeout=GET_UPDATES_TIMEOUT)
+            await app.start()
+            logger.info(f"Тенант {tenant} запущен: героев {len(users.namespace(tenant))}, файл {data_file_for(tenant)}")
+    except BaseException:
+        logger.error(f"Не удалось запустить тенанта {tenant}, останавливаем уже запущенных")
+        await stop_tenants(apps)
+        await shared_request.close()
+        await background_request.close()
+        raise
+    return apps
+
+async def stop_tenants(apps):
+    for app in apps:
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+async def run_tenants(tenants):
+    apps = await start_tenants(tenants)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Windows: остановка по KeyboardInterrupt
+    logger.info(f"Запущено тенантов: {len(apps)}")
+    try:
+        await stop_event.wait()
+    finally:
+        await stop_tenants(apps)
+
+# Регистрация обработчиков (общая для бота и replay.py)
+def register_handlers(app):
+    if RECORD_FILE:
+        # Группа -1 выполняется до основных обработчиков и не мешает им
+        app.add_handler(TypeHandler(Update, record_update), group=-1)
+        logger.info(f"Запись обновлений включена: {RECORD_FILE}")
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(button_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
@@ -841,9 +1502,24 @@ def main():
     app.add_handler(CommandHandler("fight", fight))
     app.add_handler(CommandHandler("description", description))
     app.add_error_handler(error_handler)
+
+# Главная функция
+def main():
+    if RECORD_FILE and not RECORD_SALT:
+        logger.error("TQ_RECORD_FILE задан без TQ_RECORD_SALT: запись не анонимна, бот не запущен")
+        sys.exit(1)
+    if TENANTS:
+        asyncio.run(run_tenants(parse_tenants(TENANTS)))
+        return
+    if not BOT_TOKEN:
+        logger.error("Не задан токен бота: укажи TQ_BOT_TOKEN (или TQ_TENANTS для нескольких ботов)")
+        sys.exit(1)
+    users.namespaces[DEFAULT_TENANT] = load_data()
+    app = build_application(BOT_TOKEN)
+    register_handlers(app)
     
-    logger.info("Бот запущен")
-    app.run_polling()
+    logger.info(f"Бот запущен (пул: {POOL_SIZE}, фоновый пул: {BACKGROUND_POOL_SIZE}, параллельных обновлений: {CONCURRENT_UPDATES}, HTTP {HTTP_VERSION})")
+    app.run_polling(timeout=GET_UPDATES_TIMEOUT)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import importlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Настройка логирования
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DATA_FILE = "data.json"
+CHUNK_SIZE = 5000
+HERO_KEYS = ("name", "class", "level", "exp", "coins", "energy", "inventory", "region", "quests_completed", "current_quest")
+
+# Встроенные преобразования героя. Каждое получает копию героя и возвращает нового героя.
+def recalc_level(user):
+    level = 1
+    while user["exp"] >= level * 10:
+        level += 1
+    user["level"] = level
+    return user
+
+def compact_inventory(user):
+    # Без пустых записей, одинаковые предметы подряд в порядке первого появления
+    order = {}
+    for item in user["inventory"]:
+        if item:
+            order[item] = order.get(item, 0) + 1
+    user["inventory"] = [item for item, count in order.items() for _ in range(count)]
+    return user
+
+def reset_stuck_quests(user):
+    # Квесты живут только в памяти процесса бота, после перезапуска current_quest навсегда зависает
+    user["current_quest"] = None
+    return user
+
+TRANSFORMS = {
+    "recalc_level": recalc_level,
+    "compact_inventory": compact_inventory,
+    "reset_stuck_quests": reset_stuck_quests,
+}
+
+# Имя встроенного преобразования или "модуль:функция" для пользовательского
+def resolve_transform(spec):
+    if spec in TRANSFORMS:
+        return TRANSFORMS[spec]
+    module_name, _, func_name = spec.partition(":")
+    if not func_name:
+        raise ValueError(f"Неизвестное преобразование: {spec}")
+    return getattr(importlib.import_module(module_name), func_name)
+
+# Выполняется в процессе пула: возвращает только изменившихся героев.
+# Преобразование, вернувшее не героя (например, None после правки на месте), валит весь чанк
+def process_chunk(index, chunk, specs):
+    transforms = [resolve_transform(spec) for spec in specs]
+    changed = {}
+    for user_id, user in chunk.items():
+        before = json.dumps(user, sort_keys=True)
+        new_user = json.loads(before)
+        for spec, transform in zip(specs, transforms):
+            new_user = transform(new_user)
+            if not isinstance(new_user, dict):
+                raise ValueError(f"{spec} вернул {type(new_user).__name__} вместо героя для {user_id}")
+            missing = [key for key in HERO_KEYS if key not in new_user]
+            if missing:
+                raise ValueError(f"{spec} вернул героя {user_id} без полей: {', '.join(missing)}")
+        if json.dumps(new_user, sort_keys=True) != before:
+            changed[user_id] = new_user
+    return index, changed
+
+def diff_user(old, new):
+    lines = []
+    for key in sorted(set(old) | set(new)):
+        if old.get(key) != new.get(key):
+            lines.append(f"    {key}: {json.dumps(old.get(key), ensure_ascii=False)} -> {json.dumps(new.get(key), ensure_ascii=False)}")
+    return lines
+
+def data_generation(data_file):
+    st = os.stat(data_file)
+    return [st.st_mtime_ns, st.st_size]
+
+# Чекпоинт — JSON Lines: заголовок с параметрами запуска, затем по строке на готовый чанк
+def load_checkpoint(path, header):
+    done = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            if json.loads(f.readline()) != header:
+                logger.warning("Чекпоинт от другого запуска или другой версии базы, начинаем заново.")
+                return done
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # Недописанная строка после падения
+                done[record["chunk"]] = record["changed"]
+    except FileNotFoundError:
+        pass
+    return done
+
+def run(data_file, specs, workers, chunk_size, dry_run, checkpoint, show):
+    for spec in specs:
+        resolve_transform(spec)
+    with open(data_file, "r") as f:
+        users = json.load(f)
+    user_ids = sorted(users)
+    chunks = [user_ids[i:i + chunk_size] for i in range(0, len(user_ids), chunk_size)]
+
+    header = {"transforms": specs, "chunk_size": chunk_size, "generation": data_generation(data_file)}
+    done = {} if dry_run else load_checkpoint(checkpoint, header)
+    if done:
+        logger.info(f"Продолжаем с чекпоинта: готово {len(done)} из {len(chunks)} чанков")
+    elif not dry_run:
+        with open(checkpoint, "w", encoding="utf-8") as f:
+            f.write(json.dumps(header) + "\n")
+
+    started = time.perf_counter()
+    processed = sum(len(chunks[i]) for i in done)
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(os.devnull if dry_run else checkpoint, "a", encoding="utf-8") as log:
+        futures = [
+            pool.submit(process_chunk, i, {user_id: users[user_id] for user_id in chunk}, specs)
+            for i, chunk in enumerate(chunks) if i not in done
+        ]
+        for future in as_completed(futures):
+            try:
+                index, changed = future.result()
+            except ValueError as e:
+                for pending in futures:
+                    pending.cancel()
+                logger.error(f"{e}. База не изменена, готовые чанки сохранены в чекпоинте.")
+                sys.exit(1)
+            done[index] = changed
+            log.write(json.dumps({"chunk": index, "changed": changed}, ensure_ascii=False) + "\n")
+            log.flush()
+            processed += len(chunks[index])
+            elapsed = time.perf_counter() - started
+            logger.info(f"Чанк {index + 1}/{len(chunks)}: обработано {processed}/{len(user_ids)} героев, {processed / elapsed:.0f} героев/с")
+
+    changed = {}
+    for chunk_changed in done.values():
+        changed.update(chunk_changed)
+    elapsed = time.perf_counter() - started
+    logger.info(f"Изменено героев: {len(changed)} из {len(user_ids)} за {elapsed:.1f} с")
+
+    if dry_run:
+        for user_id in sorted(changed)[:show]:
+            print(f"{user_id}:")
+            print("\n".join(diff_user(users[user_id], changed[user_id])))
+        if len(changed) > show:
+            print(f"... и ещё {len(changed) - show}")
+        return changed
+
+    if data_generation(data_file) != header["generation"]:
+        logger.error("data.json изменился во время обслуживания (бот запущен?). Результат не записан, чекпоинт сохранён.")
+        sys.exit(1)
+    users.update(changed)
+    tmp_file = data_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(users, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, data_file)
+    os.remove(checkpoint)
+    logger.info(f"База {data_file} обновлена")
+    return changed
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетное обслуживание базы героев TimeQuest (бот должен быть остановлен)")
+    parser.add_argument("transforms", nargs="+", help=f"встроенные ({', '.join(TRANSFORMS)}) или модуль:функция")
+    parser.add_argument("--data", default=DATA_FILE, help="файл базы героев")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="число процессов")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="героев в одном чанке")
+    parser.add_argument("--dry-run", action="store_true", help="показать изменения, не записывая базу")
+    parser.add_argument("--show", type=int, default=20, help="сколько героев показывать в режиме --dry-run")
+    parser.add_argument("--checkpoint", help="файл чекпоинта (по умолчанию <data>.maintenance)")
+    args = parser.parse_args()
+
+    # Пользовательские модули ищем в текущем каталоге
+    sys.path.insert(0, os.getcwd())
+    checkpoint = args.checkpoint or args.data + ".maintenance"
+    run(args.data, args.transforms, args.workers, args.chunk_size, args.dry_run, checkpoint, args.show)
+
+if __name__ == "__main__":
+    main()
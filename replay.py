@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import contextvars
+from collections import Counter, defaultdict
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+import main
+
+# Воспроизведение записанного трафика (TQ_RECORD_FILE) через настоящие обработчики main.py
+# против фейкового Bot API. Отчёт сравнивается между двумя версиями кода командой compare.
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+logger = logging.getLogger(__name__)
+logging.getLogger("main").setLevel(logging.WARNING)
+
+replay_index = contextvars.ContextVar("replay_index", default=None)
+
+# Фейковый Bot API на уровне транспорта PTB: отвечает правдоподобными объектами и пишет вызовы
+class FakeRequest(BaseRequest):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self.message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if api_method != "getMe":
+            self.calls.append((replay_index.get(), api_method, params.get("text") or params.get("caption")))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "TimeQuest", "username": "timequest_replay_bot"}
+        elif api_method in ("sendMessage", "sendPhoto", "editMessageText"):
+            if api_method == "editMessageText":
+                message_id = params.get("message_id")
+            else:
+                self.message_id += 1
+                message_id = self.message_id
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", 1), "type": "private"},
+                "text": params.get("text") or "",
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+def update_route(update):
+    if update.callback_query:
+        return update.callback_query.data
+    if update.message and update.message.text:
+        if update.message.text.startswith("/"):
+            return update.message.text.split()[0]
+        return "message"
+    return "other"
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else 0
+
+# Окна времени main.py заданы в секундах записи. При --speed они сжимаются так же,
+# как паузы между обновлениями, иначе ускорение меняет поведение (debounce, тайм-ауты диалогов)
+BASE_TIMING = {
+    "DEFAULT_DEBOUNCE_WINDOW": main.DEFAULT_DEBOUNCE_WINDOW,
+    "DEBOUNCE_WINDOWS": dict(main.DEBOUNCE_WINDOWS),
+    "STATE_TIMEOUTS": dict(main.STATE_TIMEOUTS),
+    "STATE_SWEEP_INTERVAL": main.STATE_SWEEP_INTERVAL,
+    "QUEST_SECONDS_PER_MINUTE": main.QUEST_SECONDS_PER_MINUTE,
+    "QUEST_PROGRESS_INTERVAL": main.QUEST_PROGRESS_INTERVAL,
+}
+
+def scale_timing(speed):
+    for name, value in BASE_TIMING.items():
+        if isinstance(value, dict):
+            setattr(main, name, {key: seconds / speed for key, seconds in value.items()})
+        else:
+            setattr(main, name, value / speed)
+
+def update_user(update):
+    return update.effective_user.id if update.effective_user else None
+
+def load_recording(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Герои под теми же анонимными id, что и пользователи в записи (та же соль TQ_RECORD_SALT),
+# имена маскируются так же, как first_name в записи: настоящие данные не копируются никуда
+def anonymize_store(data_file):
+    with open(data_file, "r") as f:
+        store = json.load(f)
+    return {str(main.anonymize_id(int(user_id))): dict(hero, name="hero") for user_id, hero in store.items()}
+
+async def replay(records, data_file, speed, seed, api_latency, salt=main.RECORD_SALT):
+    main.RECORD_FILE = None
+    main.RECORD_SALT = salt
+    main.RANDOM_SEED = str(seed)
+    main.user_rngs.clear()
+    scale_timing(speed)
+
+    # Работаем с анонимизированной копией базы (или с пустой), чтобы не трогать настоящую
+    if data_file and os.path.exists(data_file):
+        if not salt:
+            raise ValueError("Для копии базы нужна соль записи (--salt или TQ_RECORD_SALT); --data '' — пустая база")
+        store = anonymize_store(data_file)
+    else:
+        store = {}
+    workdir = tempfile.mkdtemp(prefix="tq-replay-")
+    main.DATA_FILE = os.path.join(workdir, "data.json")
+    main.users.namespaces[main.DEFAULT_TENANT] = store
+
+    request = FakeRequest(api_latency)
+    app = Application.builder().token("1:REPLAY").request(request).get_updates_request(FakeRequest()).concurrent_updates(True).build()
+    main.register_handlers(app)
+    await app.initialize()
+
+    latencies = defaultdict(list)
+    routes = {}
+
+    # Обновления одного пользователя обрабатываются по одному и в порядке записи,
+    # разных пользователей — параллельно, как в боте
+    async def process(index, update, previous):
+        if previous:
+            await asyncio.wait([previous])
+        replay_index.set(index)
+        started = time.perf_counter()
+        await app.process_update(update)
+        latencies[routes[index]].append(time.perf_counter() - started)
+
+    tasks = []
+    user_tasks = {}
+    started = time.monotonic()
+    for index, record in enumerate(records):
+        delay = record["t"] / speed - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = Update.de_json(record["update"], app.bot)
+        routes[index] = update_route(update)
+        user = update_user(update)
+        user_tasks[user] = asyncio.create_task(process(index, update, user_tasks.get(user)))
+        tasks.append(user_tasks[user])
+    await asyncio.gather(*tasks)
+    # Квесты завершаются в фоновых задачах после ответа обработчика
+    while main.quest_tasks:
+        await asyncio.gather(*main.quest_tasks)
+    await main.flush_pending_writes()
+    await app.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    api_calls = defaultdict(Counter)
+    for index, api_method, _ in request.calls:
+        api_calls[routes.get(index, "background")][api_method] += 1
+    return {
+        "updates": len(records),
+        "speed": speed,
+        "seed": seed,
+        "routes": {
+            route: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.5), 2),
+                "p95_ms": round(percentile(values, 0.95), 2),
+                "api_calls": dict(api_calls[route]),
+            }
+            for route, values in sorted(latencies.items())
+        },
+        "calls": request.calls,
+    }
+
+def compare(base, new):
+    print(f"{'маршрут':<20} {'p50 было':>9} {'p50 стало':>10} {'p95 было':>9} {'p95 стало':>10}  вызовы API")
+    for route in sorted(set(base["routes"]) | set(new["routes"])):
+        old = base["routes"].get(route, {"p50_ms": 0, "p95_ms": 0, "api_calls": {}})
+        cur = new["routes"].get(route, {"p50_ms": 0, "p95_ms": 0, "api_calls": {}})
+        calls = []
+        for api_method in sorted(set(old["api_calls"]) | set(cur["api_calls"])):
+            before, after = old["api_calls"].get(api_method, 0), cur["api_calls"].get(api_method, 0)
+            if before != after:
+                calls.append(f"{api_method} {before}->{after}")
+        print(f"{route:<20} {old['p50_ms']:>9.1f} {cur['p50_ms']:>10.1f} {old['p95_ms']:>9.1f} {cur['p95_ms']:>10.1f}  {', '.join(calls) or 'без изменений'}")
+
+    # Последовательности вызовов по каждому обновлению (фоновые правки прогресса зависят от времени)
+    def by_update(report):
+        result = defaultdict(list)
+        for index, api_method, text in report["calls"]:
+            result[index].append((api_method, text))
+        return result
+    base_calls, new_calls = by_update(base), by_update(new)
+    differing = [index for index in set(base_calls) | set(new_calls) if base_calls.get(index) != new_calls.get(index)]
+    print(f"Обновлений с другими вызовами API: {len(differing)} из {max(base['updates'], new['updates'])}")
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика TimeQuest")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run", help="прогнать запись через обработчики")
+    run_parser.add_argument("recording", help="файл, записанный с TQ_RECORD_FILE")
+    run_parser.add_argument("--data", default=main.DATA_FILE, help="исходная база героев (копируется с анонимными id; '' — пустая база)")
+    run_parser.add_argument("--salt", default=main.RECORD_SALT, help="соль, с которой сделана запись (TQ_RECORD_SALT)")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="ускорение времени (1 = как в записи)")
+    run_parser.add_argument("--seed", type=int, default=0, help="зерно случайности боёв и отдыха")
+    run_parser.add_argument("--api-latency", type=float, default=0.0, help="задержка фейкового API, с")
+    run_parser.add_argument("--report", help="сохранить отчёт в JSON")
+    compare_parser = sub.add_parser("compare", help="сравнить два отчёта")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.base, "r", encoding="utf-8") as f:
+            base = json.load(f)
+        with open(args.new, "r", encoding="utf-8") as f:
+            new = json.load(f)
+        compare(base, new)
+        return
+
+    try:
+        report = asyncio.run(replay(load_recording(args.recording), args.data, args.speed, args.seed, args.api_latency, args.salt))
+    except ValueError as e:
+        parser.error(str(e))
+    for route, stats in report["routes"].items():
+        print(f"{route:<20} n={stats['count']:<5} p50={stats['p50_ms']:7.1f} мс  p95={stats['p95_ms']:7.1f} мс  API: {stats['api_calls']}")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,68 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+import main
+
+
+@pytest.fixture(autouse=True)
+def routed(monkeypatch):
+    main.inflight_callbacks.clear()
+    main.last_callback.clear()
+    main.callback_stats.clear()
+    main.route_runs.clear()
+    main.route_api_calls.clear()
+    calls = []
+
+    async def route_callback(update, context):
+        calls.append(update.callback_query.data)
+
+    monkeypatch.setattr(main, "route_callback", route_callback)
+    yield calls
+    main.last_callback.clear()
+
+
+def tap(data, user_id=1):
+    async def answer():
+        pass
+    query = SimpleNamespace(data=data, from_user=SimpleNamespace(id=user_id), answer=answer)
+    return SimpleNamespace(callback_query=query)
+
+
+def run_taps(*taps):
+    async def go():
+        for data in taps:
+            await main.button_handler(tap(data), None)
+    asyncio.run(go())
+
+
+def test_repeated_tap_is_debounced(routed):
+    run_taps("status", "status")
+    assert routed == ["status"]
+    assert main.callback_stats["debounced"] == 1
+
+
+def test_tap_after_other_button_is_not_debounced(routed):
+    run_taps("status", "inventory", "status")
+    assert routed == ["status", "inventory", "status"]
+    assert main.callback_stats["debounced"] == 0
+
+
+def test_other_users_are_independent(routed):
+    async def go():
+        await main.button_handler(tap("status", 1), None)
+        await main.button_handler(tap("status", 2), None)
+    asyncio.run(go())
+    assert routed == ["status", "status"]
+
+
+def test_counters_are_keyed_by_known_routes(routed):
+    run_taps("class_Knight", "difficulty_Easy", "garbage-1", "garbage-2")
+    assert set(main.route_runs) == {"class_*", "difficulty_*", "unknown"}
+    assert main.route_runs["unknown"] == 2
+
+
+def test_callback_report_counts_suppressed(routed):
+    run_taps("fight", "fight", "fight")
+    report = main.callback_report()
+    assert report["runs"] == 1 and report["debounced"] == 2
+    assert report["api_calls_saved"] == 2.0
@@ -0,0 +1,47 @@
+import json
+import pytest
+import maintenance
+
+
+def hero(**fields):
+    user = {
+        "name": "Артур", "class": "Knight", "level": 1, "exp": 25, "coins": 0, "energy": 100,
+        "inventory": ["Меч", "", "Меч"], "region": 0, "quests_completed": 0, "current_quest": {"title": "x"},
+    }
+    user.update(fields)
+    return user
+
+
+def edit_in_place(user):
+    user["coins"] = 1
+
+
+def drop_name(user):
+    del user["name"]
+    return user
+
+
+def test_builtin_transforms_return_only_changed():
+    _, changed = maintenance.process_chunk(0, {"1": hero(), "2": hero(level=3, inventory=[], current_quest=None)}, ["recalc_level", "compact_inventory", "reset_stuck_quests"])
+    assert set(changed) == {"1"}
+    assert changed["1"]["level"] == 3
+    assert changed["1"]["inventory"] == ["Меч", "Меч"]
+    assert changed["1"]["current_quest"] is None
+
+
+@pytest.mark.parametrize("spec, message", [
+    ("test_maintenance:edit_in_place", "NoneType"),
+    ("test_maintenance:drop_name", "name"),
+])
+def test_chunk_fails_on_invalid_transform_result(spec, message):
+    with pytest.raises(ValueError, match=message):
+        maintenance.process_chunk(0, {"1": hero()}, [spec])
+
+
+def test_run_does_not_write_invalid_heroes(tmp_path):
+    data_file = tmp_path / "data.json"
+    data_file.write_text(json.dumps({"1": hero()}))
+    before = data_file.read_text()
+    with pytest.raises(SystemExit):
+        maintenance.run(str(data_file), ["test_maintenance:edit_in_place"], 1, 10, False, str(tmp_path / "ckpt"), 20)
+    assert data_file.read_text() == before
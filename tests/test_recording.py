@@ -0,0 +1,43 @@
+import pytest
+import main
+
+
+@pytest.fixture(autouse=True)
+def salt(monkeypatch):
+    monkeypatch.setattr(main, "RECORD_SALT", "secret")
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Показать меню", "Показать меню"),
+    ("готово", "готово"),
+    ("Готово, готово", "Готово, готово"),
+    ("готово меню", "xxxxxxxxxxx"),
+    ("Показать меню готово", "x" * 20),
+    ("Иван", "xxxx"),
+    ("/start", "/start"),
+    ("/start ref-ivan-79991234567", "/start"),
+])
+def test_anonymize_text(text, expected):
+    assert main.anonymize_text(text) == expected
+
+
+def test_anonymize_keeps_only_command_entity():
+    message = {
+        "text": "/start payload",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}, {"type": "mention", "offset": 7, "length": 7}],
+    }
+    assert main.anonymize(message) == {"text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}
+
+
+def test_anonymize_id_depends_on_salt_and_does_not_collide(monkeypatch):
+    ids = {main.anonymize_id(user_id) for user_id in range(100000)}
+    assert len(ids) == 100000
+    first = main.anonymize_id(42)
+    monkeypatch.setattr(main, "RECORD_SALT", "other")
+    assert main.anonymize_id(42) != first
+
+
+def test_anonymize_id_requires_salt(monkeypatch):
+    monkeypatch.setattr(main, "RECORD_SALT", None)
+    with pytest.raises(RuntimeError):
+        main.anonymize_id(42)
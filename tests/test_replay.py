@@ -0,0 +1,55 @@
+import asyncio
+import pytest
+import main
+import replay
+
+USER = 111
+
+
+@pytest.fixture(autouse=True)
+def restore_main(monkeypatch):
+    for name in ("DATA_FILE", "RECORD_FILE", "RECORD_SALT", "RANDOM_SEED"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    main.last_callback.clear()
+    yield
+    replay.scale_timing(1)
+    main.users.namespaces.clear()
+    main.last_callback.clear()
+
+
+def callback(update_id, data):
+    sender = {"id": USER, "is_bot": False, "first_name": "user"}
+    chat = {"id": USER, "type": "private"}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": "c", "data": data, "from": sender,
+        "message": {"message_id": 1, "date": 0, "chat": chat, "text": "x"},
+    }}
+
+
+def message(update_id, text):
+    sender = {"id": USER, "is_bot": False, "first_name": "user"}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": {"id": USER, "type": "private"}, "from": sender, "text": text,
+    }}
+
+
+def run(records, speed):
+    report = asyncio.run(replay.replay(records, "", speed, 0, 0.0))
+    return [(method, text) for _, method, text in report["calls"] if method != "answerCallbackQuery"]
+
+
+def test_speed_scales_debounce_windows():
+    records = [{"t": i * 2.5, "update": callback(i, "status")} for i in range(4)]
+    report = asyncio.run(replay.replay(records, "", 50, 0, 0.0))
+    assert report["routes"]["status"]["count"] == 4
+
+
+
+def test_user_updates_keep_recorded_order():
+    records = [
+        {"t": 0, "update": callback(1, "create")},
+        {"t": 3, "update": message(2, "Артур")},
+        {"t": 5, "update": callback(3, "class_Knight")},
+    ]
+    calls = run(records, 6000)
+    assert [text for _, text in calls] == ["Введи имя героя:", "Имя: Артур\nВыбери класс:", "Герой Артур (Knight) создан!"]
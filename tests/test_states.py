@@ -0,0 +1,163 @@
+import json
+import asyncio
+from types import SimpleNamespace
+import pytest
+import main
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DATA_FILE", str(tmp_path / "data.json"))
+    main.users.namespaces.clear()
+    yield main.users
+    main.users.namespaces.clear()
+
+
+def make_hero(**fields):
+    hero = {
+        "name": "Артур", "class": "Knight", "level": 1, "exp": 0, "coins": 0, "energy": 100,
+        "inventory": [], "region": 0, "quests_completed": 0, "current_quest": None,
+    }
+    hero.update(fields)
+    return hero
+
+
+def test_create_name_moves_to_class_choice():
+    user_data = {}
+    text, markup = main.on_create_name(user_data, "1", "Артур")
+    assert user_data["state"] == "create_class"
+    assert user_data["hero_name"] == "Артур"
+    assert "state_since" in user_data
+    assert markup is main.CLASS_MENU
+    assert "Артур" in text
+
+
+def test_edit_name_moves_to_class_choice():
+    user_data = {}
+    main.on_edit_name(user_data, "1", "Мерлин")
+    assert user_data["state"] == "edit_class"
+    assert user_data["hero_name"] == "Мерлин"
+
+
+def test_quest_text_moves_to_difficulty():
+    user_data = {}
+    text, markup = main.on_quest_text(user_data, "1", "Написать код")
+    assert user_data["state"] == "quest_difficulty"
+    assert user_data["quest_text"] == "Написать код"
+    assert markup is main.DIFFICULTY_MENU
+
+
+def test_transition_refreshes_state_since():
+    user_data = {"state": "create_name", "state_since": 0.0}
+    main.on_create_name(user_data, "1", "Артур")
+    assert not main.state_expired(user_data, user_data["state_since"] + main.STATE_TIMEOUTS["create_class"] - 1)
+
+
+def test_rest_rejects_other_words(store):
+    store["1"] = make_hero(energy=50)
+    user_data = {}
+    main.enter_state(user_data, "rest", rest_count=0)
+    text, markup = main.on_rest(user_data, "1", "готово нет")
+    assert text in main.REST_ERROR_MESSAGES
+    assert user_data["rest_count"] == 0
+    assert markup is main.SHOW_MENU_KEYBOARD
+
+
+def test_rest_counts_words_and_restores_energy(store):
+    store["1"] = make_hero(energy=50)
+    user_data = {}
+    main.enter_state(user_data, "rest", rest_count=0)
+    main.on_rest(user_data, "1", "готово, готово")
+    assert user_data["state"] == "rest"
+    assert user_data["rest_count"] == 2
+    text, _ = main.on_rest(user_data, "1", "Готово готово готово")
+    assert "state" not in user_data and "rest_count" not in user_data
+    assert store["1"]["energy"] == 70
+    assert "70" in text
+    with open(main.DATA_FILE) as f:
+        assert json.load(f)["1"]["energy"] == 70
+
+
+def test_create_class_creates_hero(store):
+    user_data = {}
+    main.on_create_name(user_data, "1", "Артур")
+    text, _ = main.on_create_class(user_data, "1", "Mage")
+    assert store["1"]["name"] == "Артур"
+    assert store["1"]["class"] == "Mage"
+    assert "state" not in user_data and "hero_name" not in user_data
+
+
+def test_edit_class_updates_hero(store):
+    store["1"] = make_hero()
+    user_data = {}
+    main.on_edit_name(user_data, "1", "Мерлин")
+    main.on_edit_class(user_data, "1", "Mage")
+    assert (store["1"]["name"], store["1"]["class"]) == ("Мерлин", "Mage")
+    assert "state" not in user_data
+
+
+def test_quest_difficulty_starts_quest(store):
+    store["1"] = make_hero(energy=40)
+    user_data = {}
+    main.on_quest_text(user_data, "1", "Написать код")
+    text, markup = main.on_quest_difficulty(user_data, "1", "Medium")
+    assert store["1"]["current_quest"] == {"title": "Победить дракона Написать код", "time": 30, "exp": 25}
+    assert store["1"]["energy"] == 10
+    assert markup is None
+    assert "state" not in user_data
+
+
+def test_quest_difficulty_rejects_second_quest_and_low_energy(store):
+    quest = {"title": "x", "time": 15, "exp": 10}
+    store["1"] = make_hero(current_quest=quest)
+    store["2"] = make_hero(energy=10)
+    for user_id in ("1", "2"):
+        user_data = {}
+        main.on_quest_text(user_data, user_id, "Написать код")
+        main.on_quest_difficulty(user_data, user_id, "Easy")
+        assert "state" not in user_data
+    assert store["1"]["current_quest"] is quest
+    assert store["2"]["current_quest"] is None and store["2"]["energy"] == 10
+
+
+def test_callback_transitions_match_states():
+    for state, (event, transition) in main.CALLBACK_TRANSITIONS.items():
+        assert state in main.STATE_TIMEOUTS
+        assert event in ("class_", "difficulty_")
+    assert set(main.TEXT_TRANSITIONS) <= set(main.STATE_TIMEOUTS)
+
+
+def test_state_expired_uses_per_state_timeout():
+    user_data = {}
+    main.enter_state(user_data, "quest_text", quest_text="x")
+    since = user_data["state_since"]
+    assert not main.state_expired(user_data, since + main.STATE_TIMEOUTS["quest_text"] - 1)
+    assert main.state_expired(user_data, since + main.STATE_TIMEOUTS["quest_text"] + 1)
+    assert not main.state_expired({}, since)
+
+
+def test_get_state_clears_expired_dialog():
+    context = SimpleNamespace(user_data={})
+    main.set_state(context, "quest_text", quest_text="x")
+    assert main.get_state(context) == "quest_text"
+    context.user_data["state_since"] -= main.STATE_TIMEOUTS["quest_text"] + 1
+    assert main.get_state(context) is None
+    assert "quest_text" not in context.user_data
+
+
+def test_sweeper_clears_only_expired(monkeypatch):
+    monkeypatch.setattr(main, "STATE_SWEEP_INTERVAL", 0)
+    stale, fresh = {}, {}
+    main.enter_state(stale, "rest", rest_count=2)
+    main.enter_state(fresh, "rest", rest_count=3)
+    stale["state_since"] -= main.STATE_TIMEOUTS["rest"] + 1
+    app = SimpleNamespace(user_data={1: stale, 2: fresh})
+
+    async def sweep_once():
+        sweeper = asyncio.create_task(main.sweep_expired_states(app))
+        await asyncio.sleep(0.01)
+        sweeper.cancel()
+
+    asyncio.run(sweep_once())
+    assert stale == {}
+    assert fresh["state"] == "rest" and fresh["rest_count"] == 3
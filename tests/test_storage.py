@@ -0,0 +1,118 @@
+import json
+import asyncio
+import pytest
+import main
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DATA_FILE", str(tmp_path / "data.json"))
+    monkeypatch.setattr(main, "SAVE_RETRY_DELAY", 0)
+    main.users.namespaces.clear()
+    main.data_writers.clear()
+    yield main.users
+    main.users.namespaces.clear()
+    main.data_writers.clear()
+
+
+def failing_writes(monkeypatch, failures):
+    write = main.write_data_file
+    calls = []
+
+    def flaky(data_file, payload):
+        calls.append(payload)
+        if len(calls) <= failures:
+            raise PermissionError("data.json открыт другим процессом")
+        write(data_file, payload)
+
+    monkeypatch.setattr(main, "write_data_file", flaky)
+    return calls
+
+
+def test_failed_write_is_retried_until_saved(store, monkeypatch):
+    calls = failing_writes(monkeypatch, 3)
+
+    async def save():
+        store["1"] = {"energy": 50}
+        main.save_data()
+        await main.flush_pending_writes()
+
+    asyncio.run(save())
+    assert len(calls) == 4
+    with open(main.DATA_FILE) as f:
+        assert json.load(f) == {"1": {"energy": 50}}
+
+
+def test_newer_snapshot_replaces_failed_one(store, monkeypatch):
+    calls = failing_writes(monkeypatch, 1)
+
+    async def save():
+        store["1"] = {"energy": 50}
+        main.save_data()
+        await asyncio.sleep(0)
+        store["1"] = {"energy": 70}
+        main.save_data()
+        await main.flush_pending_writes()
+
+    asyncio.run(save())
+    with open(main.DATA_FILE) as f:
+        assert json.load(f) == {"1": {"energy": 70}}
+    assert json.loads(calls[-1]) == {"1": {"energy": 70}}
+
+
+def test_final_failure_is_reported(store, monkeypatch):
+    monkeypatch.setattr(main, "SAVE_RETRIES", 2)
+    calls = failing_writes(monkeypatch, 100)
+
+    async def save():
+        store["1"] = {"energy": 50}
+        main.save_data()
+        with pytest.raises(OSError, match="не сохранены"):
+            await main.flush_pending_writes()
+
+    asyncio.run(save())
+    assert len(calls) == main.SAVE_RETRIES + 1
+    assert main.data_writers[main.DATA_FILE]["payload"] is not None
+
+
+def test_flush_retries_snapshot_left_after_failures(store, monkeypatch):
+    monkeypatch.setattr(main, "SAVE_RETRIES", 0)
+    failing_writes(monkeypatch, 1)
+
+    async def save():
+        store["1"] = {"energy": 50}
+        main.save_data()
+        await main.data_writers[main.DATA_FILE]["task"]
+        assert main.data_writers[main.DATA_FILE]["payload"] is not None
+        await main.flush_pending_writes()
+
+    asyncio.run(save())
+    with open(main.DATA_FILE) as f:
+        assert json.load(f) == {"1": {"energy": 50}}
+
+
+def test_shared_state_is_flushed_once_after_last_app(monkeypatch):
+    flushes = []
+    stops = []
+
+    async def flush():
+        flushes.append(main.running_apps["holders"])
+
+    async def stop_watchdog():
+        stops.append(True)
+
+    monkeypatch.setattr(main, "flush_pending_writes", flush)
+    monkeypatch.setattr(main, "stop_loop_watchdog", stop_watchdog)
+    monkeypatch.setitem(main.running_apps, "holders", 2)
+
+    class App:
+        bot_data = {}
+
+    async def shutdown_all():
+        await main.post_shutdown(App())
+        assert flushes == []
+        await main.post_shutdown(App())
+
+    asyncio.run(shutdown_all())
+    assert flushes == [0]
+    assert len(stops) == 2